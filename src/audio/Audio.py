@@ -1,6 +1,12 @@
+import hashlib
+import os
 import pyttsx3
 import pathlib
+import queue
+import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from os import environ
 
@@ -9,6 +15,7 @@ src = pathlib.Path(__file__).parent.absolute().parent.absolute()
 path.append(str(src.parent.absolute()))
 
 from src.misc.Log import log
+from src.misc.Helpers import PHRASES_DIR, ArtifactStore, artifact_store
 
 environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
 
@@ -66,43 +73,258 @@ for letter in 'abcdefgh':
         AudioMessages[f"{letter}{number}"] = f"{letter.replace('a', 'ayy')} {number}"
 
 
-def generate_audio_files(audio_ids):
+PIECE_NAMES = {
+    'p': 'pawn',
+    'r': 'rook',
+    'n': 'knight',
+    'b': 'bishop',
+    'q': 'queen',
+    'k': 'king'
+}
+
+TTS_VOICE = 'Samantha'
+TTS_RATE = 180
+
+
+def create_tts_engine():
+    """
+    Creates a text to speech engine with Beth's voice, or the default voice if it is not installed.
+    """
     engine = pyttsx3.init()
     voices = list(
-        filter(lambda x: x.languages[0].startswith('en') and x.name in ['Samantha'], engine.getProperty('voices')))
-    engine.setProperty('voice', voices[0].id)
-    engine.setProperty('rate', 180)
+        filter(lambda x: len(x.languages) > 0 and str(x.languages[0]).startswith('en') and x.name in [TTS_VOICE],
+               engine.getProperty('voices')))
+    if len(voices) > 0:
+        engine.setProperty('voice', voices[0].id)
+    engine.setProperty('rate', TTS_RATE)
+    return engine
+
+
+def generate_audio_files(audio_ids):
+    engine = create_tts_engine()
     for audio_id in audio_ids:
         print(f"Generating audio for id {audio_id} saving to " + str(directory.joinpath(f"{audio_id}.wav").absolute()))
         engine.save_to_file(audio_ids[audio_id], str(directory.joinpath(f"{audio_id}.wav").absolute()))
     engine.runAndWait()
 
 
+def synthesize_phrase(phrase, path):
+    """
+    Renders the phrase to a wav file. Runs in a worker process.
+    :return: The path of the wav file.
+    """
+    engine = create_tts_engine()
+    temporary_path = f"{path[:-len('.wav')]}.tmp.wav"
+    engine.save_to_file(phrase, temporary_path)
+    engine.runAndWait()
+    os.replace(temporary_path, path)
+    return path
+
+
+def get_move_announcement(move, board_state):
+    """
+    :param board_state: {dict} The board before the move is made.
+    :return: The phrase announcing the move, e.g. 'knight g 8 to f 6'.
+    """
+    s_sid, e_sid = move[:2], move[2:4]
+    piece = PIECE_NAMES.get(board_state.get(s_sid, '').lower(), 'piece')
+    phrase = f"{piece} {AudioMessages[s_sid]} {'takes' if e_sid in board_state else 'to'} {AudioMessages[e_sid]}"
+    if len(move) == 5:
+        phrase += f", promoting to a {PIECE_NAMES.get(move[4].lower(), 'piece')}"
+    return phrase
+
+
+class AudioService:
+    """
+    Plays audio on a background thread. The mixer is initialized once and every clip is loaded into
+    memory up front, then requests are played from a queue in the order they were made so speech can
+    overlap whatever the caller does next.
+    """
+
+    def __init__(self, audio_directory=directory, phrase_directory=PHRASES_DIR):
+        """
+        :param audio_directory: Directory of the clips in {AudioMessages}.
+        :param phrase_directory: Directory synthesized phrases are cached in, named by a hash of their contents.
+        """
+        self.directory = audio_directory
+        self.phrase_directory = phrase_directory
+        self.sounds = {}
+        self.requests = queue.Queue()
+        self.worker = None
+        self.start_lock = threading.Lock()
+        self.synthesis_pool = None
+        self.synthesis = {}
+        self.synthesis_lock = threading.RLock()
+
+    def start(self):
+        """
+        Starts the worker, which initializes the mixer and preloads the clips before playing anything.
+        """
+        with self.start_lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self._run, name='audio', daemon=True)
+            self.worker.start()
+
+    def preload(self):
+        pygame.mixer.init()
+        for audio_id in AudioMessages:
+            p = self.directory.joinpath(f"{audio_id}.wav")
+            if p.exists():
+                self.sounds[audio_id] = pygame.mixer.Sound(str(p))
+        log.info(f"Loaded {len(self.sounds)} audio clips.")
+
+    def get_sound_from_path(self, path):
+        if path not in self.sounds:
+            self.sounds[path] = pygame.mixer.Sound(path)
+        return self.sounds[path]
+
+    def get_sound(self, audio_id):
+        if audio_id not in self.sounds:
+            self.sounds[audio_id] = pygame.mixer.Sound(str(self.directory.joinpath(f"{audio_id}.wav")))
+        return self.sounds[audio_id]
+
+    def play(self, *ids):
+        """
+        Queues the audio ids to be played in the order they are listed. If a list of audio ids is
+        supplied as an id, one of them is picked at random.
+        :return: {threading.Event} Set once the ids have been played.
+        """
+        done = threading.Event()
+        if SKIP_AUDIO:
+            done.set()
+            return done
+        self.start()
+        self.requests.put((ids, done))
+        return done
+
+    def get_phrase_path(self, phrase):
+        key = hashlib.sha1(f"{TTS_VOICE}|{TTS_RATE}|{phrase}".encode()).hexdigest()
+        return str(self.phrase_directory.joinpath(f"{key}.wav"))
+
+    def synthesize(self, phrase):
+        """
+        Synthesizes the phrase in a worker process unless it is cached already. Phrases are recorded in
+        the artifact store so the cache is kept within the runtime dir budgets.
+        :return: {Future} Resolves to the path of the wav file.
+        """
+        path = self.get_phrase_path(phrase)
+        with self.synthesis_lock:
+            future = self.synthesis.get(path)
+            if future is None and not os.path.exists(path):
+                if self.synthesis_pool is None:
+                    os.makedirs(self.phrase_directory, exist_ok=True)
+                    self.synthesis_pool = ProcessPoolExecutor(max_workers=1)
+                log.info(f"Synthesizing phrase '{phrase}'")
+                try:
+                    future = self.synthesis_pool.submit(synthesize_phrase, phrase, path)
+                except BrokenProcessPool:
+                    # The worker process died, start a new one
+                    log.warn('Speech synthesis process stopped, restarting it.')
+                    self.synthesis_pool = ProcessPoolExecutor(max_workers=1)
+                    future = self.synthesis_pool.submit(synthesize_phrase, phrase, path)
+                self.synthesis[path] = future
+                future.add_done_callback(lambda _: self._finish_synthesis(path))
+        if future is not None:
+            return future
+        # Recording a cached phrase again keeps the cache in least recently used order
+        artifact_store.record(path, ArtifactStore.KIND_PHRASE)
+        future = Future()
+        future.set_result(path)
+        return future
+
+    def _finish_synthesis(self, path):
+        with self.synthesis_lock:
+            future = self.synthesis.pop(path, None)
+        if future is not None and future.exception() is None:
+            artifact_store.record(path, ArtifactStore.KIND_PHRASE)
+
+    def prerender(self, *phrases):
+        """
+        Synthesizes phrases that are likely to be said soon so saying them does not wait on synthesis.
+        """
+        if SKIP_AUDIO:
+            return
+        for phrase in phrases:
+            self.synthesize(phrase)
+
+    def say(self, phrase):
+        """
+        Queues a phrase to be spoken as a single clip, synthesizing it first if it is not cached.
+        :return: {threading.Event} Set once the phrase has been spoken.
+        """
+        if SKIP_AUDIO:
+            done = threading.Event()
+            done.set()
+            return done
+        return self.play(self.synthesize(phrase))
+
+    def wait_until_idle(self, timeout=None):
+        """
+        Waits until every queued id has been played.
+        :return: {bool} False if the timeout passed first.
+        """
+        done = self.play()
+        return done.wait(timeout)
+
+    def _run(self):
+        # Errors are logged and never end the worker, otherwise every later request would wait forever
+        try:
+            self.preload()
+        except Exception as error:
+            log.error(f"Could not initialize audio: {error}")
+        while True:
+            ids, done = self.requests.get()
+            try:
+                self._play_ids(ids)
+            except Exception as error:
+                log.error(f"Could not play audio {ids}: {error}")
+            finally:
+                done.set()
+
+    def _play_ids(self, ids):
+        for i in ids:
+            # Synthesized phrases are queued as the future of their wav file
+            if isinstance(i, Future):
+                if i.exception() is not None:
+                    log.error(f"Could not synthesize phrase: {i.exception()}")
+                    continue
+                path = i.result()
+                log.info(f"Playing phrase '{path}'")
+                self._play_sound(self.get_sound_from_path(path))
+                continue
+            if len(i) == 0:
+                continue
+            if type(i) == list:
+                i = random.choice(i)
+            if i == AUDIO_IDS.PAUSE_HALF_SECOND:
+                time.sleep(0.5)
+                continue
+            elif i == AUDIO_IDS.PAUSE_SECOND:
+                time.sleep(1)
+                continue
+            log.info(f"Playing audio '{i}'")
+            self._play_sound(self.get_sound(i))
+
+    @staticmethod
+    def _play_sound(sound):
+        channel = sound.play()
+        # Sleep for the length of the clip instead of spinning, then wait out any remainder
+        time.sleep(sound.get_length())
+        while channel is not None and channel.get_busy():
+            time.sleep(0.01)
+
+
+# Global audio service available for use
+audio_service = AudioService()
+
+
 def play_audio_ids(*ids):
     """
-    Plays the audio ids in the order they are listed. If a list of audio ids is
-    supplied as
+    Plays the audio ids in the order they are listed without waiting for them to finish.
+    :return: {threading.Event} Set once the ids have been played.
     """
-    if SKIP_AUDIO:
-        return
-    pygame.mixer.init()
-    for i in ids:
-        if len(i) == 0:
-            continue
-        if type(i) == list:
-            i = random.choice(i)
-        if i == AUDIO_IDS.PAUSE_HALF_SECOND:
-            time.sleep(0.5)
-            continue
-        elif i == AUDIO_IDS.PAUSE_SECOND:
-            time.sleep(1)
-            continue
-        p = str(directory.joinpath(f"{i}.wav").absolute())
-        log.info(f"Playing audio '{i}'")
-        pygame.mixer.music.load(p)
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy():
-            continue
+    return audio_service.play(*ids)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,245 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from stockfish import Stockfish
+
+from src.misc.Log import log
+
+
+class EngineProcess:
+    """
+    A single Stockfish process that remembers the position it was last given. Positions that extend the
+    previous one only send the new moves, so the engine keeps its hash table between turns.
+    """
+
+    def __init__(self, path, threads=1, hash_size=16):
+        self.engine = Stockfish(path, parameters={'Threads': threads, 'Hash': hash_size})
+        self.lock = threading.Lock()
+        self.fen = None
+        self.moves = None
+
+    def set_position(self, moves, fen=None):
+        """
+        Sets the position to the moves made from the fen, or from the starting position if no fen is given.
+        """
+        moves = list(moves)
+        if self.moves is not None and self.fen == fen and moves[:len(self.moves)] == self.moves:
+            if len(moves) > len(self.moves):
+                self.engine.make_moves_from_current_position(moves[len(self.moves):])
+        elif fen is None:
+            self.engine.set_position(moves)
+        else:
+            self.engine.set_fen_position(fen)
+            if len(moves) > 0:
+                self.engine.make_moves_from_current_position(moves)
+        self.fen = fen
+        self.moves = moves
+
+    def reset(self):
+        self.fen = None
+        self.moves = None
+
+    def quit(self):
+        """
+        Stops the Stockfish process.
+        """
+        with self.lock:
+            engine, self.engine = self.engine, None
+            self.reset()
+            if engine is None:
+                return
+            if hasattr(engine, 'send_quit_command'):
+                engine.send_quit_command()
+            # Older versions of the wrapper send quit when the instance is deleted
+            del engine
+
+
+class EngineService:
+    """
+    Long lived pool of Stockfish processes shared by the whole program. The service follows the
+    Stockfish interface for the current position so it can be used wherever an engine instance was,
+    and adds searches that run in the background on the other processes of the pool.
+    Searches started with {ponder} are kept and reused when the position they were started for is reached.
+    Searches are skipped for positions found in the {MoveCache}.
+    """
+
+    def __init__(self, path, processes=2, threads=1, hash_size=16, move_cache=None):
+        """
+        :param path: Path to the Stockfish binary.
+        :param processes: Number of engine processes. Background searches run concurrently on all of them.
+        :param threads: Threads used by each process.
+        :param hash_size: Hash table size of each process in MB.
+        :param move_cache: {MoveCache} Known best moves consulted before searching.
+        """
+        self.path = path
+        self.process_count = max(1, processes)
+        self.threads = threads
+        self.hash_size = hash_size
+        self.move_cache = move_cache
+        self.processes = []
+        self.idle_processes = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=self.process_count, thread_name_prefix='engine')
+        self.start_lock = threading.Lock()
+        self.fen = None
+        self.moves = []
+        self.pondering = {}
+        # Incremented whenever the pondered searches are discarded so late predictions are not stored
+        self.pondering_generation = 0
+        self.pondering_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the engine processes if they are not running yet.
+        """
+        with self.start_lock:
+            if len(self.processes) > 0:
+                return
+            log.info(f"Starting {self.process_count} engine process(es).")
+            for _ in range(self.process_count):
+                process = EngineProcess(self.path, threads=self.threads, hash_size=self.hash_size)
+                self.processes.append(process)
+                self.idle_processes.put(process)
+
+    def new_game(self):
+        """
+        Resets the current position and discards background searches.
+        """
+        self.start()
+        self.fen = None
+        self.moves = []
+        self.clear_pondering()
+        for process in self.processes:
+            with process.lock:
+                process.reset()
+        if self.move_cache is not None:
+            self.move_cache.save()
+
+    def _run(self, fen, moves, command):
+        """
+        Runs the command on an idle process positioned at the moves.
+        """
+        self.start()
+        process = self.idle_processes.get()
+        try:
+            with process.lock:
+                process.set_position(moves, fen=fen)
+                return command(process.engine)
+        finally:
+            self.idle_processes.put(process)
+
+    def set_position(self, moves):
+        self.fen = None
+        self.moves = list(moves)
+
+    def set_fen_position(self, fen):
+        self.fen = fen
+        self.moves = []
+
+    def get_fen_position(self):
+        return self._run(self.fen, self.moves, lambda engine: engine.get_fen_position())
+
+    def get_board_visual(self):
+        return self._run(self.fen, self.moves, lambda engine: engine.get_board_visual())
+
+    def is_move_correct(self, move):
+        return self._run(self.fen, self.moves, lambda engine: engine.is_move_correct(move))
+
+    def get_best_move_time(self, time):
+        """
+        :param time: Search time in ms.
+        :return: The best move from the current position, or None if there are no moves.
+        """
+        return self.get_best_move(self.moves, time)
+
+    def _search(self, fen, moves, time):
+        """
+        Returns the best move after the moves, from the move cache if it is known.
+        """
+        def command(engine):
+            if self.move_cache is None:
+                return engine.get_best_move_time(time)
+            position = engine.get_fen_position()
+            move = self.move_cache.get(position, time)
+            if move is None:
+                move = engine.get_best_move_time(time)
+                self.move_cache.put(position, time, move)
+            return move
+        return self._run(fen, moves, command)
+
+    def get_best_move_async(self, moves, time):
+        """
+        Searches the position after the moves on an idle process.
+        :return: {Future} Resolves to the best move.
+        """
+        return self.pool.submit(self._search, self.fen, list(moves), time)
+
+    def get_best_move(self, moves, time):
+        """
+        Returns the best move after the moves, reusing a pondered search of the position if there is one.
+        """
+        search = self.clear_pondering().get((self.fen, tuple(moves)))
+        if search is not None:
+            log.info('Using pondered search.')
+            return search.result()
+        return self.get_best_move_async(moves, time).result()
+
+    def get_pondered_search(self, moves):
+        """
+        :return: {Future} The pondered search of the position after the moves, None if it is not being pondered.
+        """
+        with self.pondering_lock:
+            return self.pondering.get((self.fen, tuple(moves)))
+
+    def clear_pondering(self):
+        """
+        Discards the pondered searches. Predictions still running are not stored.
+        :return: {dict} The discarded searches.
+        """
+        with self.pondering_lock:
+            pondering, self.pondering = self.pondering, {}
+            self.pondering_generation += 1
+        return pondering
+
+    def ponder(self, moves, reply_time, time):
+        """
+        Predicts the opponent's reply to the moves and, in the background, searches the position that
+        follows it so the search is ready if the prediction is played.
+        :param reply_time: Search time in ms for the opponent's reply.
+        :param time: Search time in ms for the answer to the reply.
+        :return: {Future} Resolves to the predicted reply, None if the opponent has no moves.
+        """
+        moves, fen = list(moves), self.fen
+        with self.pondering_lock:
+            generation = self.pondering_generation
+
+        def predict():
+            reply = self._search(fen, moves, reply_time)
+            if reply is not None:
+                with self.pondering_lock:
+                    # The position was left or the searches were discarded while predicting
+                    if generation != self.pondering_generation:
+                        return reply
+                    self.pondering[(fen, tuple(moves + [reply]))] = \
+                        self.get_best_move_async(moves + [reply], time)
+            return reply
+
+        return self.pool.submit(predict)
+
+    def close(self):
+        """
+        Waits for running searches, saves the move cache and stops the engine processes. The service
+        starts new processes if it is used again.
+        """
+        # Discarding first keeps predictions that are still running from starting searches on the closing pool
+        self.clear_pondering()
+        self.pool.shutdown(wait=True)
+        if self.move_cache is not None:
+            self.move_cache.save()
+        with self.start_lock:
+            for process in self.processes:
+                process.quit()
+            self.clear_pondering()
+            self.processes = []
+            self.idle_processes = queue.Queue()
+            self.pool = ThreadPoolExecutor(max_workers=self.process_count, thread_name_prefix='engine')
@@ -0,0 +1,112 @@
+import os
+import threading
+from collections import OrderedDict
+
+from src.misc.Helpers import save_json_to_runtime_dir, load_json_from_runtime_dir
+from src.misc.Log import log
+
+try:
+    import chess
+    import chess.polyglot
+except ImportError:
+    chess = None
+
+
+def get_position_key(fen):
+    """
+    :return: The fen without the move counters so transpositions share an entry.
+    """
+    return ' '.join(fen.split()[:4])
+
+
+class MoveCache:
+    """
+    Best moves looked up by position before searching. Positions are looked up in the Polyglot
+    opening book first, then in a cache of previous search results that is kept on disk between games.
+    The cache holds at most {max_entries} positions and evicts the least recently used ones. New results
+    only mark the cache as changed, it is written to disk by {save}.
+    """
+
+    def __init__(self, cache_file=None, max_entries=5000, book_path=None):
+        """
+        :param cache_file: Name of the cache file in the runtime dir. None to disable the cache.
+        :param max_entries: Number of positions kept in the cache.
+        :param book_path: Path to a Polyglot opening book. None to disable the book.
+        """
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.book = None
+        if book_path is not None:
+            if chess is None:
+                log.warn('python-chess is not installed. The opening book is disabled.')
+            elif not os.path.exists(book_path):
+                log.warn(f"Opening book {book_path} does not exist. The opening book is disabled.")
+            else:
+                self.book = chess.polyglot.open_reader(book_path)
+        self.load()
+
+    def get_book_move(self, fen):
+        if self.book is None:
+            return None
+        entry = self.book.get(chess.Board(fen))
+        return None if entry is None else entry.move.uci()
+
+    def get(self, fen, time):
+        """
+        :param time: Search time in ms the move must have been searched for at least.
+        :return: The best move for the position, or None if it is not known.
+        """
+        move = self.get_book_move(fen)
+        if move is not None:
+            log.info(f"Found book move {move}.")
+            return move
+        key = get_position_key(fen)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['time'] < time:
+                return None
+            self.entries.move_to_end(key)
+        log.info(f"Found cached move {entry['move']}.")
+        return entry['move']
+
+    def put(self, fen, time, move):
+        """
+        Stores the result of a search.
+        """
+        if self.cache_file is None or move is None:
+            return
+        key = get_position_key(fen)
+        with self.lock:
+            self.entries[key] = {'move': move, 'time': time}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def load(self):
+        if self.cache_file is None:
+            return
+        entries = load_json_from_runtime_dir(self.cache_file)
+        if entries is None:
+            return
+        with self.lock:
+            self.entries = OrderedDict(list(entries.items())[-self.max_entries:])
+        log.info(f"Loaded {len(self.entries)} cached moves.")
+
+    def save(self):
+        """
+        Writes the cache to disk if it changed since it was last saved.
+        """
+        if self.cache_file is None:
+            return
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                entries = dict(self.entries)
+                self.dirty = False
+            save_json_to_runtime_dir(self.cache_file, entries)
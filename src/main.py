@@ -11,13 +11,23 @@ LOG_DIR = str(src.parent.absolute().joinpath('runtime').absolute().joinpath('log
 
 from src.tracking.Board import Board, KeyPosition
 from src.tracking.Marker import Marker
+from src.tracking.BoardScanner import BoardScanner
+from src.tracking.BoardTracker import IncrementalBoardTracker
+from src.tracking.MoveRecognizer import MoveRecognizer
+from src.tracking.MoveGenerator import apply_move
+from src.planning.PathPlanner import PathPlanner
+from src.planning.SetupPlanner import SetupPlanner
+from src.planning.Graveyard import Graveyard
+from src.engine.EngineService import EngineService
+from src.engine.MoveCache import MoveCache
 from src.mechanical.Camera import Camera
 from src.mechanical.Gantry import Gantry
+from src.mechanical.CatFoot import Stepper, ServoTimingModel, create_pulse_backend
 from src.misc.Exceptions import InvalidMove, InconsistentBoardState, NoMoveFound
 from src.misc.Helpers import *
 from src.calibration.Calibration import calculate_fid_correction_coefficients
 from src.misc.Log import log
-from src.audio.Audio import play_audio_ids, AUDIO_IDS
+from src.audio.Audio import play_audio_ids, audio_service, get_move_announcement, AudioMessages, AUDIO_IDS
 
 
 """
@@ -43,8 +53,27 @@ key_positions = [
 extension_values = config['z-axis-extension']
 min_extension = extension_values['min']
 max_extension = extension_values['max']
+z_clearance = extension_values['clearance']
 z_axis_extension = {p: max_extension - extension_values[p] for p in Board.get_black_pieces()}
 game_options_map = config['game-options']
+# Configure the apriltag detectors
+Marker.set_detector_options(
+    quad_decimate=config['apriltag']['quad-decimate'],
+    nthreads=config['apriltag']['nthreads'],
+    refine_edges=config['apriltag']['refine-edges']
+)
+# Configure the retention of images and logs in the runtime dir
+artifact_store.configure(
+    max_bytes=config['runtime-store']['max-bytes'],
+    max_ages=config['runtime-store']['max-ages']
+)
+# Configure the background writer for debug frames
+artifact_writer.configure(
+    queue_size=config['artifacts']['queue-size'],
+    encoder=config['artifacts']['encoder'],
+    quality=config['artifacts']['quality'],
+    thumbnail_scale=config['artifacts']['thumbnail-scale']
+)
 # Init the camera
 camera = Camera(
     camera_index=0,
@@ -61,7 +90,23 @@ board = Board(
     a8_position=config['known-square-positions']['a8'],
     h8_position=config['known-square-positions']['h8']
 )
+# Init the graveyard captured pieces are placed in
+graveyard = Graveyard(
+    origin=config['graveyard']['origin'],
+    columns=config['graveyard']['columns'],
+    rows=config['graveyard']['rows'],
+    spacing=config['graveyard']['spacing'],
+    state_file=config['graveyard']['state-file']
+)
+# Init the path planner
+path_planner = PathPlanner(
+    turn_penalty=config['path-planning']['turn-penalty'],
+    allow_diagonal=config['path-planning']['allow-diagonal'],
+    allow_between_squares=config['path-planning']['allow-between-squares'],
+    max_turns=config['path-planning']['max-turns']
+)
 # Init the gantry
+Stepper.set_pulse_backend(create_pulse_backend(config['gantry']['pulse-backend']))
 gantry = Gantry(
     size=(
         config['gantry']['size']['x'],
@@ -81,8 +126,51 @@ gantry = Gantry(
     grip_sig_pin=config['gantry']['pins']['grip']['sig'],
     x_stop_pin=config['gantry']['pins']['stops']['x'],
     y0_stop_pin=config['gantry']['pins']['stops']['y0'],
-    y1_stop_pin=config['gantry']['pins']['stops']['y1']
+    y1_stop_pin=config['gantry']['pins']['stops']['y1'],
+    z_timing_model=ServoTimingModel(
+        measurements=config['gantry']['z-timing']['measurements'],
+        settle_margin=config['gantry']['z-timing']['settle-margin']
+    ),
+    acceleration=config['gantry']['acceleration'],
+    junction_deviation=config['gantry']['junction-deviation']
+)
+# Init the setup planner. The cost of moving a piece is given in squares of travel.
+setup_planner = SetupPlanner(
+    board=board,
+    move_cost=config['setup']['move-cost'] * board.get_square_distance('a1', 'b1')
+)
+# Init the board scanner
+board_scanner = BoardScanner(
+    gantry=gantry,
+    camera=camera,
+    board=board,
+    key_positions=key_positions,
+    fcc_map=fcc_map,
+    roi_undistortion=config['camera']['roi-undistortion'],
+    roi_scale=config['apriltag']['roi-scale'],
+    detection_workers=config['board-scan']['detection-workers']
+)
+# Init the trackers used to find the player's move. The tracking method is one of 'full', 'incremental' or 'candidates'.
+tracking_method = config['tracking']['method']
+board_tracker = IncrementalBoardTracker(
+    scanner=board_scanner,
+    difference_threshold=config['tracking']['difference-threshold']
+)
+move_recognizer = MoveRecognizer(scanner=board_scanner)
+# Init the chess engine service. Search times are in ms.
+engine_service = EngineService(
+    path=config['chess-engine']['path'],
+    processes=config['chess-engine']['processes'],
+    threads=config['chess-engine']['threads'],
+    hash_size=config['chess-engine']['hash'],
+    move_cache=MoveCache(
+        cache_file=config['chess-engine']['cache-file'],
+        max_entries=config['chess-engine']['cache-size'],
+        book_path=config['chess-engine']['book']
+    )
 )
+engine_move_time = config['chess-engine']['move-time']
+engine_reply_time = config['chess-engine']['reply-time']
 
 """
 Define main functions.
@@ -97,6 +185,58 @@ def get_extension_amount(piece):
         return 1
 
 
+def transfer_piece(piece, s_location, e_location):
+    """
+    Lifts the piece at one location and places it at the other. The piece is carried clear of the board.
+    """
+    extension_amount = get_extension_amount(piece)
+    gantry.set_position(*s_location)
+    gantry.set_z_position(extension_amount)
+    gantry.engage_grip()
+    gantry.set_z_position(min_extension, clearance=z_clearance)
+    gantry.set_position(*e_location)
+    gantry.set_z_position(extension_amount)
+    gantry.release_grip()
+    gantry.set_z_position(min_extension)
+
+
+def move_piece_to_graveyard(piece, location, route_end=None):
+    """
+    Moves the piece at the location to the free graveyard slot closest to the route from the location to
+    {route_end}. If the graveyard is full the piece is dropped at the overflow position.
+    """
+    slot = graveyard.allocate(location, location if route_end is None else route_end)
+    if slot is None:
+        log.warn('Graveyard is full. Dropping piece at the overflow position.')
+        extension_amount = get_extension_amount(piece)
+        gantry.set_position(*location)
+        gantry.set_z_position(extension_amount)
+        gantry.engage_grip()
+        gantry.set_z_position(min_extension, clearance=z_clearance)
+        gantry.set_position(100, 100)
+        gantry.set_z_position(max_extension)
+        gantry.release_grip()
+        gantry.set_z_position(min_extension)
+        return
+    log.info(f"Moving {piece} to graveyard slot {slot}.")
+    transfer_piece(piece, location, graveyard.get_slot_location(slot))
+    graveyard.place(slot, piece)
+
+
+def retrieve_piece_from_graveyard(piece, location):
+    """
+    Places the piece from the graveyard slot closest to the location at the location.
+    :return: {bool} True if the graveyard held the piece.
+    """
+    slot = graveyard.find(piece, near=location)
+    if slot is None:
+        return False
+    log.info(f"Retrieving {piece} from graveyard slot {slot}.")
+    transfer_piece(piece, graveyard.get_slot_location(slot), location)
+    graveyard.take(slot)
+    return True
+
+
 def make_move(move, board_state):
     """
     Given a FEN move, execute the move on the board.
@@ -115,18 +255,9 @@ def make_move(move, board_state):
     ex, ey = board.get_square_location(e_sid)
     # Search for a clear path to take
     shortest_clear_path = get_shortest_clear_path(move, board_state)
-    # If move captures a piece, remove the captured piece from the board
+    # If move captures a piece, move the captured piece to the graveyard on the way to the move start
     if e_sid in board_state:
-        extension_amount = get_extension_amount(board_state[e_sid])
-        gantry.set_position(ex, ey)
-        gantry.set_z_position(extension_amount)
-        gantry.engage_grip()
-        gantry.set_z_position(min_extension)
-        # TODO: have the machine place pieces in an area they can be retrieved
-        gantry.set_position(100, 100)
-        gantry.set_z_position(max_extension)
-        gantry.release_grip()
-        gantry.set_z_position(min_extension)
+        move_piece_to_graveyard(board_state[e_sid], (ex, ey), route_end=(sx, sy))
     # Raise an exception if the board state is inconsistent with the move
     if s_sid not in board_state:
         raise InconsistentBoardState(f"Could not find piece in sid {s_sid}")
@@ -137,27 +268,29 @@ def make_move(move, board_state):
     gantry.engage_grip()
     gantry.set_z_position(
         min_extension if shortest_clear_path is None else extension_amount - 0.3,
-        delay=None if shortest_clear_path is None else 0.05
+        delay=None if shortest_clear_path is None else 0.05,
+        clearance=z_clearance if shortest_clear_path is None else None
     )
     # If a clear path exists, use it
     if shortest_clear_path is not None:
         log.info(f"Using shortest clear path {shortest_clear_path}")
-        for sid in shortest_clear_path:
-            tx, ty = board.get_square_location(sid)
-            gantry.set_position(tx, ty)
-    gantry.set_position(ex, ey)
+        gantry.follow_path([board.get_grid_location(col, row) for col, row in shortest_clear_path] + [(ex, ey)])
+    else:
+        gantry.set_position(ex, ey)
     gantry.set_z_position(
         extension_amount,
         delay=None if shortest_clear_path is None else 0.5
     )
     gantry.release_grip()
     gantry.set_z_position(min_extension)
-    # Ask for piece promotion
-    if promotion_piece is not None:
-        play_audio_ids(
-            AUDIO_IDS.PIECE_PROMOTION,
-            promotion_piece
-        )
+    # Swap the pawn for the promoted piece from the graveyard or ask for piece promotion
+    if promotion_piece is not None and graveyard.find(promotion_piece) is not None:
+        move_piece_to_graveyard(board_state[s_sid], (ex, ey), route_end=graveyard.get_slot_location(
+            graveyard.find(promotion_piece, near=(ex, ey))
+        ))
+        retrieve_piece_from_graveyard(promotion_piece, (ex, ey))
+    elif promotion_piece is not None:
+        audio_service.say(f"{AudioMessages[AUDIO_IDS.PIECE_PROMOTION]} {AudioMessages[promotion_piece]}")
     # Perform castling if required
     if is_castling:
         rx, ry = 0, 0
@@ -171,53 +304,13 @@ def make_move(move, board_state):
         gantry.set_position(rx, ry)
         gantry.set_z_position(get_extension_amount('r'))
         gantry.engage_grip()
-        gantry.set_z_position(min_extension)
+        gantry.set_z_position(min_extension, clearance=z_clearance)
         gantry.set_position(nx, ny)
         gantry.set_z_position(get_extension_amount('r'))
         gantry.release_grip()
         gantry.set_z_position(min_extension)
 
 
-def adjust_markers(markers):
-    """
-    Adjusts the markers based on the fid correction coefficient matrix.
-    :param markers: {list(markers)} List of markers
-    :return: Adjusted markers
-    """
-    frame_center = np.array([x / 2 for x in camera.frame_size])
-    for marker in markers:
-        vector = marker.center - frame_center
-        coefficient = fcc_map[marker.id] if marker.id in fcc_map else 1
-        marker.center = np.array([int(x) for x in frame_center + vector * coefficient])
-
-
-def filter_markers_by_range(markers, x_range, y_range):
-    return list(filter(
-        lambda m: (x_range[0] <= m.center[0] <= x_range[1]) and (y_range[0] <= m.center[1] <= y_range[1]),
-        markers
-    ))
-
-
-def filter_markers_by_id(markers, valid_ids):
-    return list(filter(
-        lambda m: m.id in valid_ids,
-        markers
-    ))
-
-
-def take_snapshot():
-    """
-    Captures a frame and returns a map of all markers present in the frame
-    as well as the coordinate in the center of the frame.
-    :return: [Marker] A list of markers
-    """
-    log.info('Taking snapshot from camera.')
-    frame = camera.capture_frame()
-    markers = Marker.extract_markers(frame, marker_family=Marker.FAMILY_tag16h5, scan_for_inverted_markers=True)
-    adjust_markers(markers)
-    return markers, frame
-
-
 def get_board_state(save_images=False):
     """
     Analyzes the board to find where all the pieces are.
@@ -225,24 +318,7 @@ def get_board_state(save_images=False):
     snapshot and locate the position of each of the visible pieces.
     :return: [square_id: piece.id] A map of square ids to piece ids.
     """
-    log.info('Analyzing board.')
-    board_state = {}
-    for key_position in key_positions:
-        x, y = key_position.gantry_position
-        gantry.set_position(x, y)
-        markers, frame = take_snapshot()
-        markers = filter_markers_by_range(markers, x_range=key_position.x_range, y_range=key_position.y_range)
-        markers = filter_markers_by_id(markers, valid_ids=board.piece_fids)
-        if save_images:
-            draw_markers(frame, markers, board=board)
-            save_frame_to_runtime_dir(frame, camera)
-        for marker in markers:
-            piece_id = board.translate_fid_to_piece(marker.id)
-            sid = key_position.get_closest_sid(marker.center)
-            if sid in board_state and board_state[sid] != piece_id:
-                raise BoardPieceViolation(f"Two pieces ({board_state[sid]}, {piece_id}) found in the same square: {sid}")
-            board_state[sid] = piece_id
-    log.info(f"Board state: {board_state}")
+    board_state, _ = board_scanner.scan(save_images=save_images)
     return board_state
 
 
@@ -250,94 +326,35 @@ def setup_board():
     log.info('Setting up board.')
     start_state = Board.get_starting_board_state()
     board_state = get_board_state()
-    # For each sid, move a piece that is in an incorrect location to the correct location
-    for s_sid, s_piece in start_state.items():
-        # Get sids that do not have pieces in them
-        free_sids = [sid for sid in Board.get_all_sids() if sid not in board_state]
-        # s_piece = correct piece for s_sid, b_piece = current piece in sid
-        b_piece = board_state[s_sid] if s_sid in board_state else None
-        # If the board piece is the same as the start piece, continue
-        if b_piece == s_piece:
-            continue
-        # If there is an incorrect piece in the sid, move it to a free space
-        if b_piece is not None:
-            f_sid = free_sids.pop(0)
-            make_move(f"{s_sid}{f_sid}", board_state)
-            del board_state[s_sid]
-            board_state[f_sid] = b_piece
-        # Get sids of pieces incorrectly located
-        i_sids = [
-            sid for sid, piece in board_state.items()
-            if piece == s_piece and (sid not in start_state or start_state[sid] != piece)
-        ]
-        # If there are none on the board, continue
-        if len(i_sids) == 0:
+    # Make the moves of the planned setup, keeping the board state up to date for path planning
+    for move in setup_planner.plan(board_state, start_state):
+        make_move(move, board_state)
+        s_sid, e_sid = move[:2], move[2:4]
+        board_state[e_sid] = board_state.pop(s_sid)
+    # Move pieces that are not part of the starting position to the graveyard
+    for sid in [sid for sid in board_state if sid not in start_state]:
+        move_piece_to_graveyard(board_state.pop(sid), board.get_square_location(sid))
+    # Restock missing pieces from the graveyard
+    for sid, piece in start_state.items():
+        if sid in board_state:
             continue
-        # Make the move
-        i_sid = i_sids[0]
-        make_move(f"{i_sid}{s_sid}", board_state)
-        del board_state[i_sid]
-        board_state[s_sid] = s_piece
-
-
-def refine_path(path_):
-    p = path_
-    for i in range(len(p) - 2, 0, -1):
-        b_sid, c_sid, f_sid = p[i - 1], p[i], p[i + 1]
-        b_col, b_row = list(b_sid)
-        c_col, c_row = list(c_sid)
-        f_col, f_row = list(f_sid)
-        if b_col == c_col == f_col:
-            p.pop(i)
-        if b_row == c_row == f_row:
-            p.pop(i)
-    return p
+        if retrieve_piece_from_graveyard(piece, board.get_square_location(sid)):
+            board_state[sid] = piece
+        else:
+            log.warn(f"Graveyard does not hold a {piece} for {sid}.")
 
 
 def get_shortest_clear_path(move, board_state):
     """
-    Returns the shortest path with no pieces in the way or None if there is not a clear path.
+    Returns the path with the fewest turns that has no pieces in the way or None if there is not a clear path.
+    The path is a list of (col, row) waypoints ending at the destination square.
     """
     log.info('Searching for a clear path.')
     s_sid, e_sid = move[:2], move[2:4]
-    explored = [s_sid]
-    paths = [[s_sid]]
-    # For a max of 14 steps
-    search_max = 14
-    while search_max > 0:
-        search_max -= 1
-        # For each path
-        for i in range(len(paths) - 1, -1, -1):
-            c_sid = paths[i][-1]
-            # If the path has reached the target, skip over the path
-            if c_sid == e_sid:
-                continue
-            # Get the surrounding empty and unexplored sids
-            surrounding = [sid for sid in board.get_surrounding_sids(c_sid)
-                           if (sid not in board_state or sid == e_sid) and sid not in explored]
-            # Generate new paths for each and remove the older path
-            if len(surrounding) > 0:
-                for sid in surrounding:
-                    sid_distance = np.linalg.norm(
-                        np.array(board.get_square_location(sid)) - np.array(board.get_square_location(e_sid))
-                    )
-                    c_sid_distance = np.linalg.norm(
-                        np.array(board.get_square_location(c_sid)) - np.array(board.get_square_location(e_sid))
-                    )
-                    # Mark sid as explored if it is further away from the target than the current sid
-                    # This is done to reduce jagged paths by allowing alternate equal length routes
-                    if sid_distance > c_sid_distance:
-                        explored.append(sid)
-                    paths.append(paths[i] + [sid])
-            paths.pop(i)
-    refined_paths = [refine_path(p) for p in paths if p[-1] == e_sid]
-    if len(refined_paths) == 0:
+    clear_path = path_planner.plan(s_sid, e_sid, board_state)
+    if clear_path is None:
         log.info('Could not find a clear path.')
         return None
-    clear_path = sorted(refined_paths, key=lambda x: len(x)).pop(0)
-    # If path has too many turns, return None
-    if len(clear_path) > 3:
-        return None
     log.info(f"Found clear path {clear_path}")
     return clear_path
 
@@ -358,8 +375,10 @@ def play_game():
     # Initialize state history, move list, and chess engine. Then verify the board is in starting position.
     state_history = [Board.get_starting_board_state()]
     moves = []
-    chess_engine = Board.generate_chess_engine_instance()
+    chess_engine = engine_service
+    chess_engine.new_game()
     verify_initial_state()
+    board_tracker.reset(state_history[-1])
     # Begin the game
     play_audio_ids(
         AUDIO_IDS.BEFORE_GAME,
@@ -370,27 +389,43 @@ def play_game():
         log.info('Waiting for player move')
         wait_for_player_button_press()
         # Analyze the board to get the board state. If it fails, retry once before asking for the user
-        # to intervene. Repeat until board state can be captured.
-        attempts = 0
-        should_request_user_intervention = False
-        while True:
-            attempts += 1
-            if should_request_user_intervention:
-                play_audio_ids(AUDIO_IDS.USER_CHECK_BOARD)
-                log.info('Requesting user intervention.')
-                wait_for_player_button_press()
-            try:
-                board_state = get_board_state(save_images=True)
-                break
-            except BoardPieceViolation as error:
-                log.error(error)
-                should_request_user_intervention = attempts % 2 == 0
+        # to intervene. Repeat until board state can be captured. The candidate recognizer observes the
+        # board while detecting the move instead.
+        board_state = None
+        if tracking_method != 'candidates':
+            attempts = 0
+            should_request_user_intervention = False
+            while True:
+                attempts += 1
+                if should_request_user_intervention:
+                    play_audio_ids(AUDIO_IDS.USER_CHECK_BOARD)
+                    log.info('Requesting user intervention.')
+                    wait_for_player_button_press()
+                try:
+                    if tracking_method == 'incremental':
+                        board_state = board_tracker.scan(previous_moves=moves, chess_engine=chess_engine,
+                                                         save_images=True)
+                    else:
+                        board_state = get_board_state(save_images=True)
+                    break
+                except BoardPieceViolation as error:
+                    log.error(error)
+                    should_request_user_intervention = attempts % 2 == 0
         # Get previous state in order to extract the move made by the player and add it to the move list
         previous_state = state_history[-1]
         log.debug(f"Previous state: {Board.board_state_to_fen(previous_state)}")
-        log.debug(f"Board state: {Board.board_state_to_fen(board_state)}")
         try:
-            detected_move = Board.get_move_from_board_states(previous_state, board_state, moves, chess_engine)
+            if tracking_method == 'candidates':
+                chess_engine.set_position(moves)
+                detected_move, board_state = move_recognizer.recognize(chess_engine.get_fen_position(),
+                                                                       save_images=True)
+            else:
+                detected_move = Board.get_move_from_board_states(previous_state, board_state, moves, chess_engine)
+        except BoardPieceViolation as error:
+            # If the board could not be read, ask the player to check it and try again
+            log.error(error)
+            play_audio_ids(AUDIO_IDS.USER_CHECK_BOARD)
+            continue
         except InvalidMove as err:
             # If an invalid move was detected, notify the payer and try again
             log.error(f"Invalid move detected: {err}")
@@ -401,6 +436,7 @@ def play_game():
             log.error('No move found.')
             play_audio_ids(AUDIO_IDS.NO_MOVE_FOUND)
             continue
+        log.debug(f"Board state: {Board.board_state_to_fen(board_state)}")
         log.info(f"Detected move {detected_move} from player")
         state_history.append(board_state)
         moves.append(detected_move)
@@ -409,7 +445,7 @@ def play_game():
         chess_engine.set_position(moves)
         log.debug(f"Making move from current board:\n{chess_engine.get_board_visual()}{chess_engine.get_fen_position()}")
         # Generate the best move, append it to the moves list
-        generated_move = chess_engine.get_best_move_time(2)
+        generated_move = chess_engine.get_best_move_time(engine_move_time)
         # If the move is None, the player won
         if generated_move is None:
             play_audio_ids(AUDIO_IDS.LOST)
@@ -436,22 +472,45 @@ def play_game():
         log.info(f"Moves: {','.join(moves)}")
         chess_engine.set_position(moves)
         state_history.append(Board.fen_to_board_state(chess_engine.get_fen_position()))
-        # Generate the best move for the player to take next
-        best_player_move = chess_engine.get_best_move_time(1)
-        # Make the move TODO: handle move failure
+        board_tracker.mark_changed(state_history[-1])
+        # Make the move on the gantry thread while the best move for the player to take next is generated.
+        # The answer to that move is searched in the background while waiting for the player.
         log.info(f"Making move {generated_move}")
+        audio_service.say(get_move_announcement(generated_move, board_state))
+        move_execution = gantry.executor.submit(make_move, generated_move, board_state)
+        player_prediction = chess_engine.ponder(moves, reply_time=engine_reply_time, time=engine_move_time)
         try:
-            make_move(generated_move, board_state)
-        except InvalidMove or InconsistentBoardState as err:
+            move_execution.result()
+        except (InvalidMove, InconsistentBoardState) as err:
             log.error(f"Move failed due to: {err}")
             break
+        best_player_move = player_prediction.result()
         # If the player has no valid moves, beth wins
         if best_player_move is None:
             play_audio_ids(AUDIO_IDS.WON)
             break
-        # Reset to the key position
+        prerender_move_announcement(moves + [best_player_move], apply_move(state_history[-1], best_player_move))
+        # Reset to the key position while waiting for the player
         x, y = key_positions[0].gantry_position
-        gantry.set_position(x, y)
+        gantry.executor.set_position(x, y)
+
+
+def prerender_move_announcement(moves, board_state):
+    """
+    Synthesizes the announcement of the pondered answer to the predicted player move once it is found,
+    so it can be said without waiting if the player makes the predicted move.
+    :param moves: Moves including the predicted player move.
+    :param board_state: {dict} The board after the predicted player move.
+    """
+    search = engine_service.get_pondered_search(moves)
+    if search is None:
+        return
+
+    def prerender(future):
+        if future.exception() is None and future.result() is not None:
+            audio_service.prerender(get_move_announcement(future.result(), board_state))
+
+    search.add_done_callback(prerender)
 
 
 def check_for_game_options():
@@ -527,6 +586,7 @@ def action_capture_key_position_images():
     Captures the key position and returns positional data from the calibration grid.
     """
     _ = gantry.calibrate()
+    camera.start_session()
     for key_position in key_positions:
         x, y = key_position.gantry_position
         gantry.set_position(x, y)
@@ -558,7 +618,7 @@ def action_determine_current_position():
 def action_show_board_state():
     gantry.calibrate()
     state = get_board_state(save_images=True)
-    chess_engine = Board.generate_chess_engine_instance()
+    chess_engine = engine_service
     chess_engine.set_fen_position(Board.board_state_to_fen(state))
     log.info('Board state:\n' + chess_engine.get_board_visual())
 
@@ -569,12 +629,13 @@ def action_capture_frame():
         tag = Marker.FAMILY_tag36h11 if '--36h11' in argv else Marker.FAMILY_tag16h5
         markers = Marker.extract_markers(frame, marker_family=tag, scan_for_inverted_markers=True)
         draw_markers(frame, markers, board=board, primary_color=(244, 3, 252), secondary_color=(252, 98, 3))
-        adjust_markers(markers)
+        board_scanner.adjust_markers(markers)
         draw_markers(frame, markers, point_only=True, primary_color=(107, 252, 3), secondary_color=(107, 252, 3))
     save_frame_to_runtime_dir(frame, camera)
 
 
 def action_capture_camera_distortion_images():
+    camera.start_session()
     for i in range(12):
         frame = camera.capture_frame(correct_distortion=False)
         save_frame_to_runtime_dir(frame, camera, calibration=True, name=f"cam-dis-{i}")
@@ -584,10 +645,11 @@ def action_capture_camera_distortion_images():
 def action_play_self():
     _ = gantry.calibrate()
     moves = []
-    chess_engine = Board.generate_chess_engine_instance()
+    chess_engine = engine_service
+    chess_engine.new_game()
     while True:
         chess_engine.set_position(moves)
-        move = chess_engine.get_best_move_time(1)
+        move = chess_engine.get_best_move_time(engine_reply_time)
         if move is None:
             break
         log.info(f"Making move: {move}")
@@ -705,14 +767,19 @@ if __name__ == "__main__":
             print(f"{action}\n    {desc}\n")
         exit(0)
 
-    log.enable_save_output(path=LOG_DIR)
+    log.enable_save_output(
+        path=LOG_DIR,
+        on_file_closed=lambda path: artifact_store.record(path, ArtifactStore.KIND_LOG)
+    )
     try:
         ip = os.popen('hostname -I').readlines()[0].split()[0]
     except IndexError:
         ip = 'NULL'
     log.info(f"SSH IP: {ip}")
     log.debug(f"Download runtime dir using: scp -r pi@{ip}:/home/pi/projects/beth/runtime .")
-    cleanup_runtime_dir()
+    artifact_store.enforce()
+    # Load the audio clips in the background while the program starts
+    audio_service.start()
     log.info(f"Program begin, argv: {argv}")
     try:
         run_main = True
@@ -731,9 +798,13 @@ if __name__ == "__main__":
         log.info('Program ended due to KeyboardInterrupt.')
     except Exception as e:
         log.error(f"Program execution failed. Catchall found error: {e}")
-    # Return gantry to origin and cleanup gpio
+    # Release the camera and chess engine, return gantry to origin and cleanup gpio
+    camera.end_session()
+    engine_service.close()
     gantry.set_z_position(min_extension)
     gantry.set_position(0, 0)
     gantry.release_grip()
-    # Close the log file
+    # Finish speaking, write the remaining debug frames and close the log file
+    audio_service.wait_until_idle(timeout=30)
+    artifact_writer.flush(timeout=10)
     log.close_file()
@@ -1,7 +1,10 @@
+import hashlib
+
 import cv2
 import numpy as np
 from src.misc.Exceptions import *
-from src.misc.Helpers import save_frame_to_runtime_dir
+from src.misc.Helpers import save_frame_to_runtime_dir, save_arrays_to_calibration_dir, \
+    load_arrays_from_calibration_dir
 
 from src.misc.Log import log
 
@@ -12,6 +15,10 @@ class Camera:
     class does additional computation when reading frames and initializing.
     """
 
+    # Number of frames held in the capture buffer and read after opening the camera
+    BUFFER_SIZE = 3
+    WARMUP_FRAMES = 25
+
     def __init__(self, camera_index, frame_size, k, d, frame_center=None):
         """
         Initializes the {Camera} object.
@@ -31,6 +38,9 @@ class Camera:
         else:
             self.frame_center = np.array(frame_center)
         self.exposure = None
+        self.session = None
+        self.session_exposure = None
+        self.undistortion_maps = None
 
     def generate_camera(self, exposure=None):
         """
@@ -40,27 +50,90 @@ class Camera:
         camera = cv2.VideoCapture(self.index)
         camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.frame_size[0])
         camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.frame_size[1])
-        camera.set(cv2.CAP_PROP_BUFFERSIZE, 3)
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, Camera.BUFFER_SIZE)
         e = camera.get(cv2.CAP_PROP_EXPOSURE)
         if exposure is not None:
             camera.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0.25)
             camera.set(cv2.CAP_PROP_EXPOSURE, exposure)
         self.exposure = camera.get(cv2.CAP_PROP_EXPOSURE)
-        for _ in range(25):
+        for _ in range(Camera.WARMUP_FRAMES):
             _, _ = camera.read()
         return camera
 
-    def correct_distortion(self, frame):
+    def start_session(self, exposure=None):
         """
-        Corrects distortion due to curved lenses using the distortion variables 'k' and 'd'.
-        :param frame: The frame to correct.
-        :return: The corrected frame.
+        Opens a long-lived capture session. The camera is opened and warmed up once and then
+        kept open so that subsequent captures only need to read the freshest frame.
+        :param exposure: Exposure to capture with for the duration of the session.
         """
-        log.info('Correcting camera distortion on frame.')
+        if self.session is not None:
+            if self.session_exposure == exposure:
+                return
+            self.end_session()
+        log.info('Starting camera session. Warming camera up.')
+        self.session = self.generate_camera(exposure)
+        self.session_exposure = exposure
+        if not self.session.isOpened():
+            self.session = None
+            raise CameraError('Failed to open camera session.')
+
+    def end_session(self):
+        """
+        Releases the camera held by the capture session if there is one.
+        """
+        if self.session is None:
+            return
+        log.info('Ending camera session.')
+        self.session.release()
+        self.session = None
+        self.session_exposure = None
+
+    def read_latest_frame(self):
+        """
+        Reads the freshest frame from the capture session. Frames buffered while the camera was
+        idle are drained first. If reading fails the session is reopened once before giving up.
+        :return: Raw BGR frame.
+        """
+        for attempt in range(2):
+            for _ in range(Camera.BUFFER_SIZE):
+                self.session.grab()
+            ret, frame = self.session.read()
+            if ret:
+                return frame
+            log.warn('Failed to read from camera session. Reopening camera.')
+            exposure = self.session_exposure
+            self.end_session()
+            self.start_session(exposure)
+        raise CameraError('Failed to read from camera session.')
+
+    def get_calibration_hash(self):
+        """
+        :return: {str} Hash identifying the distortion calibration and frame size.
+        """
+        h = hashlib.sha1()
+        h.update(self.k.astype(np.float64).tobytes())
+        h.update(self.d.astype(np.float64).tobytes())
+        h.update(np.array(self.frame_size, dtype=np.int64).tobytes())
+        return h.hexdigest()[:16]
+
+    def get_undistortion_maps(self):
+        """
+        Returns the fixed point undistortion maps for the camera calibration. The maps are computed once
+        and persisted to the calibration dir keyed by the calibration hash so later runs can load them.
+        :return: (m1, m2) maps for {cv2.remap}.
+        """
+        if self.undistortion_maps is not None:
+            return self.undistortion_maps
+        name = f"undistortion-maps-{self.get_calibration_hash()}"
+        arrays = load_arrays_from_calibration_dir(name)
+        if arrays is not None:
+            log.info('Loaded cached camera undistortion maps.')
+            self.undistortion_maps = arrays['m1'], arrays['m2']
+            return self.undistortion_maps
+        log.info('Generating camera undistortion maps.')
         new_k = cv2.fisheye.estimateNewCameraMatrixForUndistortRectify(self.k,
                                                                        self.d,
-                                                                       self.
-                                                                       frame_size,
+                                                                       self.frame_size,
                                                                        np.eye(3),
                                                                        balance=1)
         m1, m2 = cv2.fisheye.initUndistortRectifyMap(self.k,
@@ -68,15 +141,43 @@ class Camera:
                                                      np.eye(3),
                                                      new_k,
                                                      self.frame_size,
-                                                     cv2.CV_32FC1)
-        undistorted_img = cv2.remap(frame, m1, m2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+                                                     cv2.CV_16SC2)
+        save_arrays_to_calibration_dir(name, m1=m1, m2=m2)
+        self.undistortion_maps = m1, m2
+        return self.undistortion_maps
+
+    def correct_distortion(self, frame, rois=None):
+        """
+        Corrects distortion due to curved lenses using the distortion variables 'k' and 'd'.
+        :param frame: The frame to correct.
+        :param rois: {[(x_range, y_range)]} Regions of the corrected frame to compute. If provided, only
+        these regions are corrected and the rest of the returned frame is black.
+        :return: The corrected frame.
+        """
+        log.info('Correcting camera distortion on frame.')
+        m1, m2 = self.get_undistortion_maps()
+        if rois is None:
+            return cv2.remap(frame, m1, m2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        undistorted_img = np.zeros_like(frame)
+        height, width = frame.shape[:2]
+        for x_range, y_range in rois:
+            x0, x1 = max(0, int(x_range[0])), min(width, int(x_range[1]))
+            y0, y1 = max(0, int(y_range[0])), min(height, int(y_range[1]))
+            if x0 >= x1 or y0 >= y1:
+                continue
+            undistorted_img[y0:y1, x0:x1] = cv2.remap(frame,
+                                                      m1[y0:y1, x0:x1],
+                                                      m2[y0:y1, x0:x1],
+                                                      interpolation=cv2.INTER_LINEAR,
+                                                      borderMode=cv2.BORDER_CONSTANT)
         return undistorted_img
 
-    def capture_frame(self, correct_distortion=True, exposure=None):
+    def capture_frame(self, correct_distortion=True, exposure=None, rois=None):
         """
         Captures a raw RGB color frame from the camera. Corrects distortion if necessary.
         :param correct_distortion: Tell the function if it should correct for distortion.
         :param exposure: Exposure to capture.
+        :param rois: {[(x_range, y_range)]} Only correct distortion within these regions.
         :return: np array of pixel data
         """
         if self.mock_frame_path is not None:
@@ -84,17 +185,20 @@ class Camera:
             frame = cv2.imread(self.mock_frame_path)
             self.latest_frame = frame
             return frame
-        log.info('Warming camera up.')
-        camera = self.generate_camera(exposure)
         log.info(f"Capturing frame from camera with"
                  f"{'' if correct_distortion else ' no'} distortion correction.")
-        ret, frame = camera.read()
-        if not ret:
-            raise CameraError('Failed to read from from camera.')
-        camera.release()
+        if self.session is not None and self.session_exposure == exposure:
+            frame = self.read_latest_frame()
+        else:
+            log.info('Warming camera up.')
+            camera = self.generate_camera(exposure)
+            ret, frame = camera.read()
+            camera.release()
+            if not ret:
+                raise CameraError('Failed to read from from camera.')
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         if correct_distortion:
-            frame = self.correct_distortion(frame)
+            frame = self.correct_distortion(frame, rois=rois)
         self.latest_frame = frame
         return frame
 
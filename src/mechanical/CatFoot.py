@@ -11,6 +11,10 @@ else:
 
 import time
 import math
+from collections import deque
+
+from src.mechanical.MotionProfile import build_delays, build_step_mask, delay_to_speed, \
+    DEFAULT_ACCELERATION, PROFILE_TRAPEZOIDAL, PROFILE_S_CURVE
 
 
 gpio.setmode(gpio.BCM)
@@ -80,25 +84,311 @@ class Electromagnet:
         gpio.output(self.sig_pin, False)
 
 
+class ServoTimingModel:
+    """
+    Estimates how long a servo takes to travel between angles from measured travel times. Measurements
+    are (angle delta in degrees, seconds) pairs and are linearly interpolated.
+    """
+
+    def __init__(self, measurements=((0, 0.1), (180, 1.1)), settle_margin=0.2):
+        """
+        :param measurements: {[(float, float)]} Measured (angle delta, travel time) pairs.
+        :param settle_margin: Time in seconds added after the travel time for the servo to settle.
+        """
+        self.measurements = sorted((float(d), float(t)) for d, t in measurements)
+        if self.measurements[0][0] > 0:
+            self.measurements.insert(0, (0.0, 0.0))
+        self.settle_margin = settle_margin
+
+    def travel_time(self, delta):
+        """
+        :param delta: Angle delta in degrees.
+        :return: Seconds needed to travel the delta, excluding the settle margin.
+        """
+        delta = abs(delta)
+        points = self.measurements
+        for (d0, t0), (d1, t1) in zip(points, points[1:]):
+            if delta <= d1:
+                return t0 + (t1 - t0) * (delta - d0) / (d1 - d0) if d1 > d0 else t1
+        # Extrapolate past the last measurement using the last segment
+        if len(points) < 2:
+            return points[-1][1]
+        (d0, t0), (d1, t1) = points[-2], points[-1]
+        return t1 + (t1 - t0) / (d1 - d0) * (delta - d1) if d1 > d0 else t1
+
+    def distance_travelled(self, elapsed, delta):
+        """
+        :param elapsed: Seconds since the servo started moving.
+        :param delta: Angle delta of the move in degrees.
+        :return: Degrees travelled after {elapsed} seconds.
+        """
+        delta = abs(delta)
+        total = self.travel_time(delta)
+        if elapsed >= total or total <= 0:
+            return delta
+        # Binary search the inverse of the travel time
+        low, high = 0.0, delta
+        for _ in range(20):
+            mid = (low + high) / 2
+            if self.travel_time(mid) < elapsed:
+                low = mid
+            else:
+                high = mid
+        return low
+
+
 class Servo:
 
-    def __init__(self, sig_pin, default_delay=1.5):
+    def __init__(self, sig_pin, default_delay=1.5, timing_model=None):
+        """
+        :param sig_pin: {int} Signal pin.
+        :param default_delay: Seconds to wait after setting the angle when there is no timing model.
+        :param timing_model: {ServoTimingModel} Model used to wait only as long as the move requires.
+        """
         gpio.setup(sig_pin, gpio.OUT)
         self.pin = sig_pin
         self.pwm = gpio.PWM(sig_pin, 50)
         self.default_delay = default_delay
+        self.timing_model = timing_model
         self.pwm.start(0)
+        # Current move, used to estimate where the servo is while it travels
+        self.move_start_angle = None
+        self.move_target_angle = None
+        self.move_start_time = 0
 
-    def set_angle(self, deg, delay=None):
+    def estimate_angle(self):
+        """
+        :return: {float} Estimated current angle or None if the servo has not been set yet.
+        """
+        if self.move_target_angle is None or self.move_start_angle is None or self.timing_model is None:
+            return self.move_target_angle
+        delta = self.move_target_angle - self.move_start_angle
+        travelled = self.timing_model.distance_travelled(time.time() - self.move_start_time, delta)
+        return self.move_start_angle + math.copysign(travelled, delta)
+
+    def set_angle(self, deg, delay=None, wait_until_angle=None):
+        """
+        Sets the servo angle and waits for it to travel.
+        :param deg: Target angle.
+        :param delay: Fixed seconds to wait. Overrides the timing model.
+        :param wait_until_angle: Only wait until the servo is estimated to have passed this angle.
+        The remaining travel then overlaps with whatever the caller does next.
+        :return: {float} Seconds waited.
+        """
+        start_angle = self.estimate_angle()
         duty = deg / 18 + 2
         p_out(self.pin, True)
         self.pwm.ChangeDutyCycle(duty)
-        time.sleep(delay if delay is not None else self.default_delay)
+        self.move_start_angle = start_angle
+        self.move_target_angle = deg
+        self.move_start_time = time.time()
+        if delay is None and self.timing_model is not None:
+            if start_angle is None:
+                # Unknown start, assume a full travel
+                delay = self.timing_model.travel_time(180) + self.timing_model.settle_margin
+            elif wait_until_angle is not None and min(start_angle, deg) <= wait_until_angle <= max(start_angle, deg):
+                delay = self.timing_model.travel_time(wait_until_angle - start_angle)
+            else:
+                delay = self.timing_model.travel_time(deg - start_angle) + self.timing_model.settle_margin
+        delay = delay if delay is not None else self.default_delay
+        time.sleep(delay)
+        return delay
 
     def cleanup(self):
         self.pwm.stop()
 
 
+class StepSchedule:
+    """
+    A precomputed sequence of step pulses for a group of steppers. On every tick each stepper flagged
+    in {step_mask} raises its stp pin, waits the tick delay, lowers it and waits the delay again.
+    """
+
+    def __init__(self, stp_pins, dir_pins, directions, step_mask, delays):
+        """
+        :param stp_pins: {[int]} stp pin of each stepper.
+        :param dir_pins: {[int]} dir pin of each stepper.
+        :param directions: {[bool]} Level written to each dir pin before stepping.
+        :param step_mask: (steppers, ticks) array, step_mask[i][j] is True if stepper i steps on tick j.
+        :param delays: Delay in seconds after each edge of tick j.
+        """
+        self.stp_pins = stp_pins
+        self.dir_pins = dir_pins
+        self.directions = directions
+        self.step_mask = step_mask
+        self.delays = delays
+
+    def __len__(self):
+        return len(self.delays)
+
+    def get_tick_pins(self):
+        """
+        :return: {[[int]]} The stp pins pulsed on each tick.
+        """
+        return [
+            [pin for pin, step in zip(self.stp_pins, column) if step]
+            for column in zip(*self.step_mask)
+        ]
+
+    def get_duration(self):
+        """
+        :return: {float} Time in seconds it takes to emit the schedule.
+        """
+        return 2 * sum(self.delays)
+
+
+class PulseBackend:
+    """
+    Emits step schedules to the stepper drivers.
+    """
+
+    def emit(self, schedules):
+        """
+        Emits the schedules back to back.
+        :param schedules: {[StepSchedule]} Schedules to emit.
+        """
+        raise NotImplementedError
+
+
+class GPIOPulseBackend(PulseBackend):
+    """
+    Software timed backend that toggles the pins from Python.
+    """
+
+    def emit(self, schedules):
+        for schedule in schedules:
+            for pin, direction in zip(schedule.dir_pins, schedule.directions):
+                p_out(pin, direction)
+            for pins, delay in zip(schedule.get_tick_pins(), schedule.delays):
+                for pin in pins:
+                    p_out(pin, True)
+                time.sleep(delay)
+                for pin in pins:
+                    p_out(pin, False)
+                time.sleep(delay)
+
+
+class PigpioPulseBackend(PulseBackend):
+    """
+    Hardware timed backend that emits schedules as DMA driven pigpio waveforms. Waves are created in
+    chunks and chained with sync sends so long moves do not exhaust the wave memory.
+    """
+
+    # Maximum number of pulses in a single wave
+    CHUNK_SIZE = 4000
+    # Time in microseconds the dir pins are held before the first step
+    DIR_SETUP_US = 5
+
+    def __init__(self):
+        import pigpio
+        self.pigpio = pigpio
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise RuntimeError('Could not connect to the pigpio daemon.')
+        self.configured_pins = set()
+
+    def setup_pins(self, pins):
+        for pin in pins:
+            if pin is not None and pin not in self.configured_pins:
+                self.pi.set_mode(pin, self.pigpio.OUTPUT)
+                self.configured_pins.add(pin)
+
+    def build_pulses(self, schedules):
+        """
+        Converts the schedules to a list of pigpio pulses.
+        """
+        pulses = []
+        for schedule in schedules:
+            self.setup_pins(schedule.stp_pins + schedule.dir_pins)
+            dir_on, dir_off = 0, 0
+            for pin, direction in zip(schedule.dir_pins, schedule.directions):
+                if pin is None:
+                    continue
+                if direction:
+                    dir_on |= 1 << pin
+                else:
+                    dir_off |= 1 << pin
+            pulses.append(self.pigpio.pulse(dir_on, dir_off, PigpioPulseBackend.DIR_SETUP_US))
+            for pins, delay in zip(schedule.get_tick_pins(), schedule.delays):
+                mask = 0
+                for pin in pins:
+                    mask |= 1 << pin
+                delay_us = max(1, int(delay * 1000000))
+                pulses.append(self.pigpio.pulse(mask, 0, delay_us))
+                pulses.append(self.pigpio.pulse(0, mask, delay_us))
+        return pulses
+
+    def emit(self, schedules):
+        pulses = self.build_pulses(schedules)
+        previous_wave = None
+        for i in range(0, len(pulses), PigpioPulseBackend.CHUNK_SIZE):
+            self.pi.wave_add_generic(pulses[i:i + PigpioPulseBackend.CHUNK_SIZE])
+            wave = self.pi.wave_create()
+            if previous_wave is None:
+                self.pi.wave_send_once(wave)
+            else:
+                self.pi.wave_send_using_mode(wave, self.pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+                # Wait for the previous wave to finish before freeing it
+                while self.pi.wave_tx_at() == previous_wave:
+                    time.sleep(0.001)
+                self.pi.wave_delete(previous_wave)
+            previous_wave = wave
+        while self.pi.wave_tx_busy():
+            time.sleep(0.001)
+        if previous_wave is not None:
+            self.pi.wave_delete(previous_wave)
+
+
+class MockPulseBackend(PulseBackend):
+    """
+    Backend that records emitted schedules instead of driving pins. Used with --mock-gpio and for tests.
+    Only the most recent schedules and waveform events are kept so long mock runs do not grow without bound.
+    """
+
+    def __init__(self, max_schedules=100, max_events=100000):
+        """
+        :param max_schedules: Number of recent schedules kept.
+        :param max_events: Number of recent waveform events kept.
+        """
+        self.schedules = deque(maxlen=max_schedules)
+        self.waveform = deque(maxlen=max_events)
+        self.time = 0
+
+    def emit(self, schedules):
+        t = self.time
+        for schedule in schedules:
+            self.schedules.append(schedule)
+            self.waveform.append((t, [p for p, d in zip(schedule.dir_pins, schedule.directions) if d],
+                                  [p for p, d in zip(schedule.dir_pins, schedule.directions) if not d]))
+            for pins, delay in zip(schedule.get_tick_pins(), schedule.delays):
+                self.waveform.append((t, pins, []))
+                t += delay
+                self.waveform.append((t, [], pins))
+                t += delay
+            self.waveform.append((t, [], []))
+        self.time = t
+
+    def clear(self):
+        self.schedules.clear()
+        self.waveform.clear()
+        self.time = 0
+
+
+def create_pulse_backend(name):
+    """
+    Creates the pulse backend with the given name. The mock backend is always used with --mock-gpio.
+    :param name: 'gpio', 'pigpio' or 'mock'
+    :return: {PulseBackend}
+    """
+    if mock_gpio_enabled or name == 'mock':
+        return MockPulseBackend()
+    if name == 'pigpio':
+        return PigpioPulseBackend()
+    if name == 'gpio':
+        return GPIOPulseBackend()
+    raise ValueError(f"Unknown pulse backend '{name}'.")
+
+
 class Stepper:
     # Resolution modes
     MODE_FULL = 0
@@ -108,11 +398,12 @@ class Stepper:
     MODE_SIXTEENTH = 4
     MODE_THIRTY_TWO = 5
 
-    # Acceleration functions
-    ACCELERATION_SIN = lambda x: -math.sin(x * math.pi) + 1
-    ACCELERATION_QUAD = lambda x: (2 * x - 1) ** 4
-    ACCELERATION_LINEAR = lambda x: x
-    ACCELERATION_CONST = lambda x: 0
+    # Motion profiles
+    PROFILE_TRAPEZOIDAL = PROFILE_TRAPEZOIDAL
+    PROFILE_S_CURVE = PROFILE_S_CURVE
+
+    # Backend used to emit step pulses, see {Stepper.set_pulse_backend}
+    pulse_backend = None
 
     def __init__(self, stp_pin, dir_pin=None, en_pin=None, rst_pin=None,
                  slp_pin=None, m0_pin=None, m1_pin=None, m2_pin=None):
@@ -218,6 +509,8 @@ class Stepper:
         self._target_position += position
 
     def update_current_position_with_target(self):
+        if self._target_position is None:
+            return
         self._current_position = self._target_position
         self._target_position = None
 
@@ -225,6 +518,23 @@ class Stepper:
         self._current_position = 0
         self._target_position = None
 
+    @staticmethod
+    def set_pulse_backend(backend):
+        """
+        Sets the backend used by all steppers to emit step pulses.
+        :param backend: {PulseBackend}
+        """
+        Stepper.pulse_backend = backend
+
+    @staticmethod
+    def get_pulse_backend():
+        """
+        :return: {PulseBackend} The pulse backend, the default backend is created if none was set.
+        """
+        if Stepper.pulse_backend is None:
+            Stepper.pulse_backend = create_pulse_backend('gpio')
+        return Stepper.pulse_backend
+
     @staticmethod
     def move_concurrently(*steppers, rising_delay=0.00055, falling_delay=0.00055):
         """
@@ -233,57 +543,64 @@ class Stepper:
         :param falling_delay: Delay after the falling edge of the step pins.
         :param steppers: {list} Steppers to move.
         """
-        targets = []
-        total_step_count = 0
-        for stepper in steppers:
-            p_out(stepper.dir, stepper.get_required_direction_for_target())
-            targets.append([stepper.stp, stepper.get_required_steps_for_target()])
-            total_step_count += stepper.get_required_steps_for_target()
-        n_targets = len(targets)
-        while total_step_count > 0:
-            for i in range(n_targets):
-                if targets[i][1] > 0:
-                    targets[i][1] -= 1
-                    total_step_count -= 1
-                    p_out(targets[i][0], True)
-            time.sleep(rising_delay)
-            for i in range(n_targets):
-                p_out(targets[i][0], False)
-            time.sleep(falling_delay)
+        required_steps = [s.get_required_steps_for_target() for s in steppers]
+        max_steps = max(required_steps)
+        schedule = StepSchedule(
+            stp_pins=[s.stp for s in steppers],
+            dir_pins=[s.dir for s in steppers],
+            directions=[s.get_required_direction_for_target() for s in steppers],
+            step_mask=[[c_step < n for c_step in range(max_steps)] for n in required_steps],
+            delays=[(rising_delay + falling_delay) / 2] * max_steps
+        )
+        Stepper.get_pulse_backend().emit([schedule])
         for stepper in steppers:
             stepper.update_current_position_with_target()
 
     @staticmethod
-    def move(*steppers, min_delay=0.00035, max_delay=0.0008, acceleration_function=ACCELERATION_QUAD):
+    def build_schedule(*steppers, min_delay=0.00035, max_delay=0.0008, acceleration=DEFAULT_ACCELERATION,
+                       profile=PROFILE_TRAPEZOIDAL, start_delay=None, end_delay=None):
         """
-        Move all steppers together one step at a time until each stepper reaches its target position.
-        :param acceleration_function:
-        :param max_delay:
-        :param min_delay:
+        Precomputes the step schedule for moving the steppers to their target positions. The axis with the
+        most steps sets the pace and the other axes are interleaved so all of them finish together.
+        :param min_delay: Delay after each edge at cruise speed.
+        :param max_delay: Delay after each edge when starting and stopping.
+        :param acceleration: Acceleration limit in steps/s^2 of the fastest axis.
+        :param profile: {Stepper.PROFILE_TRAPEZOIDAL} or {Stepper.PROFILE_S_CURVE}.
+        :param start_delay: Delay of the first step if entering the move at speed. Defaults to {max_delay}.
+        :param end_delay: Delay of the last step if leaving the move at speed. Defaults to {max_delay}.
+        :return: {StepSchedule}
+        """
+        required_steps = tuple(s.get_required_steps_for_target() for s in steppers)
+        return StepSchedule(
+            stp_pins=[s.stp for s in steppers],
+            dir_pins=[s.dir for s in steppers],
+            directions=[s.get_required_direction_for_target() for s in steppers],
+            step_mask=build_step_mask(required_steps),
+            delays=build_delays(
+                max(required_steps),
+                start_speed=delay_to_speed(max_delay if start_delay is None else start_delay),
+                max_speed=delay_to_speed(min_delay),
+                acceleration=acceleration,
+                end_speed=delay_to_speed(max_delay if end_delay is None else end_delay),
+                shape=profile
+            )
+        )
+
+    @staticmethod
+    def move(*steppers, min_delay=0.00035, max_delay=0.0008, acceleration=DEFAULT_ACCELERATION,
+             profile=PROFILE_TRAPEZOIDAL):
+        """
+        Move all steppers together until each stepper reaches its target position.
+        The whole schedule is computed up front and emitted through the pulse backend.
+        :param min_delay: Delay after each edge at cruise speed.
+        :param max_delay: Delay after each edge when starting and stopping.
+        :param acceleration: Acceleration limit in steps/s^2.
+        :param profile: {Stepper.PROFILE_TRAPEZOIDAL} or {Stepper.PROFILE_S_CURVE}.
         :param steppers: {list(Stepper)} Steppers to move.
         """
-        if mock_gpio_enabled:
-            return
-        required_steps = [s.get_required_steps_for_target() for s in steppers]
-        completed = [False if required_steps[i] > 0 else True for i in range(len(steppers))]
-        max_steps = max(required_steps)
-        stepper_step_frequency = list(map(lambda x: int(math.floor(max_steps / x)) if x > 0 else 0, required_steps))
-        step_counts = [0 for _ in range(len(steppers))]
+        if max(s.get_required_steps_for_target() for s in steppers) > 0:
+            schedule = Stepper.build_schedule(*steppers, min_delay=min_delay, max_delay=max_delay,
+                                              acceleration=acceleration, profile=profile)
+            Stepper.get_pulse_backend().emit([schedule])
         for stepper in steppers:
-            p_out(stepper.dir, stepper.get_required_direction_for_target())
-        for c_step in range(max_steps):
-            delay = min_delay + acceleration_function(c_step / max_steps) * (max_delay - min_delay)
-            for i in range(len(steppers)):
-                if completed[i] or c_step % stepper_step_frequency[i] != 0:
-                    continue
-                p_out(steppers[i].stp, True)
-                step_counts[i] += 1
-            time.sleep(delay)
-            for i in range(len(steppers)):
-                if completed[i] or c_step % stepper_step_frequency[i] != 0:
-                    continue
-                p_out(steppers[i].stp, False)
-                if step_counts[i] == required_steps[i]:
-                    completed[i] = True
-                    steppers[i].update_current_position_with_target()
-            time.sleep(delay)
+            stepper.update_current_position_with_target()
@@ -1,21 +1,131 @@
+import functools
+import math
+import queue
 import random
+import threading
+from concurrent.futures import Future
 
-from src.mechanical.CatFoot import Stepper, Servo, Electromagnet, Button
+from src.mechanical.CatFoot import Stepper, Servo, ServoTimingModel, Electromagnet, Button
+from src.mechanical.MotionProfile import DEFAULT_ACCELERATION, delay_to_speed
 from src.misc.Log import log
 
 
+def serialized(func):
+    """
+    Runs the decorated gantry command only after all queued commands have finished and while
+    holding the gantry lock, so direct calls never interleave with the command queue.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self.executor.is_executor_thread():
+            self.executor.wait_until_idle()
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class GantryExecutor:
+    """
+    Runs gantry commands in order on a dedicated thread so the caller can continue working while the
+    gantry moves. Every submitted command returns a {Future}. If a command fails, the commands queued
+    behind it are cancelled instead of being run from an unexpected position.
+    """
+
+    def __init__(self, gantry):
+        self.gantry = gantry
+        self.commands = queue.Queue()
+        self.thread = None
+        self.failed = False
+
+    def is_executor_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, command, *args, **kwargs):
+        """
+        Queues a command.
+        :param command: Callable to run on the executor thread.
+        :return: {Future} Resolves with the return value of the command.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='gantry-executor', daemon=True)
+            self.thread.start()
+        future = Future()
+        self.commands.put((future, command, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            item = self.commands.get()
+            if item is None:
+                self.commands.task_done()
+                break
+            future, command, args, kwargs = item
+            if self.failed:
+                future.cancel()
+            elif future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(command(*args, **kwargs))
+                except BaseException as e:
+                    log.error(f"Gantry command {command.__name__} failed: {e}")
+                    future.set_exception(e)
+                    self.failed = True
+            if self.commands.unfinished_tasks == 1:
+                self.failed = False
+            self.commands.task_done()
+
+    def wait_until_idle(self):
+        """
+        Blocks until every queued command has finished.
+        """
+        self.commands.join()
+
+    def shutdown(self):
+        """
+        Finishes the queued commands and stops the executor thread.
+        """
+        if self.thread is None:
+            return
+        self.commands.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def set_position(self, x, y, rel=False, slow=False):
+        return self.submit(self.gantry.set_position, x, y, rel=rel, slow=slow)
+
+    def follow_path(self, waypoints, **kwargs):
+        return self.submit(self.gantry.follow_path, waypoints, **kwargs)
+
+    def set_z_position(self, p, delay=None, clearance=None):
+        return self.submit(self.gantry.set_z_position, p, delay=delay, clearance=clearance)
+
+    def engage_grip(self):
+        return self.submit(self.gantry.engage_grip)
+
+    def release_grip(self):
+        return self.submit(self.gantry.release_grip)
+
+
 class Gantry:
     """
     The gantry system used for physical movement.
     """
 
-    def __init__(self, size, stp_pins, dir_pins, z_sig_pin, grip_sig_pin, x_stop_pin, y0_stop_pin, y1_stop_pin):
+    # Distance in steps used to limit the speed through corners when following a path. Larger values
+    # allow faster cornering. With the default acceleration a right angle corner is taken at about
+    # 1040 steps/s, values below about 55 slow every right angle corner down to the start speed.
+    JUNCTION_DEVIATION = 150
+
+    def __init__(self, size, stp_pins, dir_pins, z_sig_pin, grip_sig_pin, x_stop_pin, y0_stop_pin, y1_stop_pin,
+                 z_timing_model=None, acceleration=DEFAULT_ACCELERATION, junction_deviation=JUNCTION_DEVIATION):
         """
         Initializes the gantry with the given hardware specifications.
         :param size: {(int, int)} (x_size, y_size)
         :param stp_pins: {(int, int, int)} (x_stp, y0_stp, y1_stp)
         :param dir_pins: {(int, int, int)} (x_dir, y0_dir, y1_dir)
         :param z_sig_pin: {int} Servo motor signal pin.
+        :param z_timing_model: {ServoTimingModel} Travel time model of the z servo.
+        :param acceleration: Acceleration limit in steps/s^2 of each axis when following a path.
+        :param junction_deviation: Distance in steps limiting the speed through corners when following a path.
         """
         self.x_size, self.y_size = size
         x_stp, y0_stp, y1_stp = stp_pins
@@ -24,13 +134,19 @@ class Gantry:
         self.y0_stepper = Stepper(stp_pin=y0_stp, dir_pin=y0_dir)
         self.y1_stepper = Stepper(stp_pin=y1_stp, dir_pin=y1_dir)
         self.z_delay = 1.3
-        self.z_servo = Servo(sig_pin=z_sig_pin, default_delay=self.z_delay)
+        self.z_servo = Servo(sig_pin=z_sig_pin, default_delay=self.z_delay,
+                             timing_model=z_timing_model if z_timing_model is not None else ServoTimingModel())
         self.gripper = Electromagnet(sig_pin=grip_sig_pin)
         self.x_stop = Button(pin=x_stop_pin)
         self.y0_stop = Button(pin=y0_stop_pin)
         self.y1_stop = Button(pin=y1_stop_pin)
         self.z_position = 0
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+        self.lock = threading.RLock()
+        self.executor = GantryExecutor(self)
 
+    @serialized
     def calibrate(self, test_size=False):
         """
         Calibrates the gantry and sets the current position to [0, 0]. Returns
@@ -38,17 +154,16 @@ class Gantry:
         base_distance = 150
         log.info('Starting calibration sequence.')
         self.x_stepper.set_position_rel(base_distance)
-        Stepper.move(self.x_stepper, acceleration_function=Stepper.ACCELERATION_SIN)
+        Stepper.move(self.x_stepper, profile=Stepper.PROFILE_S_CURVE)
         while not self.x_stop.is_pressed():
             self.x_stepper.set_position_rel(-3)
-            Stepper.move(self.x_stepper, acceleration_function=Stepper.ACCELERATION_CONST,
-                         min_delay=0.004, max_delay=0.004)
+            Stepper.move(self.x_stepper, min_delay=0.004, max_delay=0.004)
         log.info('X stop found.')
         x_pos = -self.x_stepper.get_current_position()
         self.x_stepper.reset()
         self.y0_stepper.set_position_rel(base_distance)
         self.y1_stepper.set_position_rel(base_distance)
-        Stepper.move(self.y0_stepper, self.y1_stepper, acceleration_function=Stepper.ACCELERATION_SIN)
+        Stepper.move(self.y0_stepper, self.y1_stepper, profile=Stepper.PROFILE_S_CURVE)
         while True:
             if self.y0_stop.is_pressed() and self.y1_stop.is_pressed():
                 break
@@ -56,8 +171,7 @@ class Gantry:
                 self.y0_stepper.set_position_rel(-3)
             if not self.y1_stop.is_pressed():
                 self.y1_stepper.set_position_rel(-3)
-            Stepper.move(self.y0_stepper, self.y1_stepper, acceleration_function=Stepper.ACCELERATION_CONST,
-                         min_delay=0.004, max_delay=0.004)
+            Stepper.move(self.y0_stepper, self.y1_stepper, min_delay=0.004, max_delay=0.004)
         log.info('Y stops found.')
         y0_pos = -self.y0_stepper.get_current_position()
         y1_pos = -self.y1_stepper.get_current_position()
@@ -75,6 +189,7 @@ class Gantry:
             Stepper.move(self.y0_stepper, self.y1_stepper, self.x_stepper)
         return x_pos, y_pos
 
+    @serialized
     def set_position(self, x, y, rel=False, slow=False):
         """
         Sets the absolute position of the gantry to the given position.
@@ -82,7 +197,7 @@ class Gantry:
         :param x: {int} The x coordinate.
         :param y: {int} The y coordinate.
         """
-        log.info(f"Setting position to ({x}, {y})")
+        log.info('Setting position to (%s, %s)', x, y)
         if rel:
             self.x_stepper.set_position_rel(int(x))
             self.y0_stepper.set_position_rel(int(y))
@@ -96,26 +211,108 @@ class Gantry:
         else:
             Stepper.move(self.x_stepper, self.y0_stepper, self.y1_stepper)
 
-    def set_z_position(self, p, delay=None):
+    @serialized
+    def follow_path(self, waypoints, min_delay=0.00035, max_delay=0.0008, acceleration=None):
+        """
+        Moves the gantry through each waypoint as one blended trajectory. The gantry only slows down at a
+        waypoint as much as the corner angle requires and only comes to a stop at the final waypoint.
+        :param waypoints: {[(int, int)]} Absolute (x, y) positions to travel through.
+        :param min_delay: Delay after each step edge at cruise speed.
+        :param max_delay: Delay after each step edge when starting and stopping.
+        :param acceleration: Acceleration limit in steps/s^2 of each axis, the gantry's acceleration if None.
+        """
+        log.info('Following path through %s', waypoints)
+        if acceleration is None:
+            acceleration = self.acceleration
+        # Build the segments, skipping waypoints that do not move the gantry
+        segments = []
+        x, y = self.x_stepper.get_current_position(), self.y0_stepper.get_current_position()
+        for tx, ty in waypoints:
+            tx, ty = int(tx), int(ty)
+            dx, dy = tx - x, ty - y
+            if dx == 0 and dy == 0:
+                continue
+            length = math.hypot(dx, dy)
+            ux, uy = dx / length, dy / length
+            # Fraction of the path speed carried by the fastest axis
+            dominant = max(abs(ux), abs(uy))
+            segments.append((tx, ty, length, (ux, uy), dominant))
+            x, y = tx, ty
+        if len(segments) == 0:
+            return
+        # Speeds are planned along the path in steps/s and converted to step rates of the fastest axis
+        min_speed, max_speed = delay_to_speed(max_delay), delay_to_speed(min_delay)
+        cruise = [max_speed / m for _, _, _, _, m in segments]
+        accelerations = [acceleration / m for _, _, _, _, m in segments]
+        # Maximum speed through each junction from the angle between the segments
+        junctions = []
+        for i in range(len(segments) - 1):
+            (ux0, uy0), m0 = segments[i][3], segments[i][4]
+            (ux1, uy1), m1 = segments[i + 1][3], segments[i + 1][4]
+            low = min_speed / max(m0, m1)
+            cos_theta = -(ux0 * ux1 + uy0 * uy1)
+            if cos_theta < -0.999:
+                v = math.inf
+            elif cos_theta > 0.999:
+                v = low
+            else:
+                sin_half = math.sqrt((1 - cos_theta) / 2)
+                v = math.sqrt(min(accelerations[i], accelerations[i + 1])
+                              * self.junction_deviation * sin_half / (1 - sin_half))
+            junctions.append(max(low, min(v, cruise[i], cruise[i + 1])))
+        entry = [min_speed / segments[0][4]] + junctions
+        exit_ = junctions + [min_speed / segments[-1][4]]
+        # Backward pass so every segment can decelerate to the next junction speed
+        for i in range(len(segments) - 1, -1, -1):
+            entry[i] = min(entry[i], math.sqrt(exit_[i] ** 2 + 2 * accelerations[i] * segments[i][2]))
+            if i > 0:
+                exit_[i - 1] = entry[i]
+        # Forward pass so every segment can accelerate to its exit speed
+        for i in range(len(segments)):
+            exit_[i] = min(exit_[i], math.sqrt(entry[i] ** 2 + 2 * accelerations[i] * segments[i][2]))
+            if i < len(segments) - 1:
+                entry[i + 1] = exit_[i]
+        schedules = []
+        for i, (tx, ty, _, _, m) in enumerate(segments):
+            self.x_stepper.set_position_abs(tx)
+            self.y0_stepper.set_position_abs(ty)
+            self.y1_stepper.set_position_abs(ty)
+            schedules.append(Stepper.build_schedule(
+                self.x_stepper, self.y0_stepper, self.y1_stepper,
+                min_delay=min_delay,
+                max_delay=max_delay,
+                acceleration=acceleration,
+                start_delay=0.5 / (entry[i] * m),
+                end_delay=0.5 / (exit_[i] * m)
+            ))
+            for stepper in [self.x_stepper, self.y0_stepper, self.y1_stepper]:
+                stepper.update_current_position_with_target()
+        Stepper.get_pulse_backend().emit(schedules)
+
+    @serialized
+    def set_z_position(self, p, delay=None, clearance=None):
         """
         Sets the Z position based on the input {p}. If p == 1 the z servo will
         be fully extended, if p == 0 the z servo will be fully retracted.
+        :param delay: Fixed seconds to wait instead of using the servo timing model.
+        :param clearance: When retracting, return as soon as the extension is at or below this value
+        so that x/y motion can start while the servo finishes travelling.
         """
         p = max(0, min(p, 1))
-        log.info(f"Setting z to {int(p * 100)}% extension.")
+        log.info('Setting z to %d%% extension.', p * 100)
         self.z_servo.set_angle(
             180 * (1 - p),
-            delay=max(
-                    self.z_delay,
-                    self.z_delay * abs(self.z_position - p)
-                 ) if delay is None else delay
+            delay=delay,
+            wait_until_angle=None if clearance is None else 180 * (1 - max(p, min(clearance, 1)))
         )
         self.z_position = p
 
+    @serialized
     def engage_grip(self):
         log.info('Engaging grip.')
         self.gripper.magnetize()
 
+    @serialized
     def release_grip(self):
         log.info('Releasing grip.')
         self.gripper.demagnetize()
@@ -0,0 +1,88 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+PROFILE_TRAPEZOIDAL = 'trapezoidal'
+PROFILE_S_CURVE = 's-curve'
+
+# Default acceleration in steps/s^2
+DEFAULT_ACCELERATION = 3000
+
+
+def _smoothstep(x):
+    return x * x * (3 - 2 * x)
+
+
+def _ramp(distance, start_speed, max_speed, acceleration, shape):
+    """
+    Speed reached after travelling {distance} steps while accelerating from {start_speed}.
+    """
+    if max_speed <= start_speed or acceleration <= 0:
+        return np.full(distance.shape, float(start_speed))
+    if shape == PROFILE_S_CURVE:
+        # Smoothstep in v^2 over a ramp 1.5x longer than the trapezoid so the peak acceleration is {acceleration}
+        length = 1.5 * (max_speed ** 2 - start_speed ** 2) / (2 * acceleration)
+        fraction = _smoothstep(np.clip(distance / length, 0, 1))
+        return np.sqrt(start_speed ** 2 + (max_speed ** 2 - start_speed ** 2) * fraction)
+    if shape == PROFILE_TRAPEZOIDAL:
+        return np.sqrt(start_speed ** 2 + 2 * acceleration * distance)
+    raise ValueError(f"Unknown motion profile '{shape}'.")
+
+
+@lru_cache(maxsize=256)
+def build_velocity_profile(n_steps, start_speed, max_speed, acceleration=DEFAULT_ACCELERATION,
+                           end_speed=None, shape=PROFILE_TRAPEZOIDAL):
+    """
+    Builds the step rate for every step of a move. The move accelerates from {start_speed}, cruises at
+    {max_speed} and decelerates to {end_speed}. Short moves never reach the cruise speed.
+    Profiles are cached by their arguments and returned read only.
+    :param n_steps: {int} Number of steps in the move.
+    :param start_speed: Entry speed in steps/s.
+    :param max_speed: Cruise speed in steps/s.
+    :param acceleration: Acceleration limit in steps/s^2.
+    :param end_speed: Exit speed in steps/s. Defaults to {start_speed}.
+    :param shape: {PROFILE_TRAPEZOIDAL} or {PROFILE_S_CURVE}.
+    :return: {np.array} Step rate in steps/s for each step.
+    """
+    end_speed = start_speed if end_speed is None else end_speed
+    steps = np.arange(n_steps, dtype=np.float64)
+    accelerating = _ramp(steps, start_speed, max_speed, acceleration, shape)
+    decelerating = _ramp(n_steps - 1 - steps, end_speed, max_speed, acceleration, shape)
+    speeds = np.minimum(np.minimum(accelerating, decelerating), max(max_speed, start_speed, end_speed))
+    speeds.flags.writeable = False
+    return speeds
+
+
+def build_delays(n_steps, start_speed, max_speed, acceleration=DEFAULT_ACCELERATION,
+                 end_speed=None, shape=PROFILE_TRAPEZOIDAL):
+    """
+    :return: {np.array} Delay in seconds after each edge of every step, half of the step period.
+    """
+    speeds = build_velocity_profile(n_steps, start_speed, max_speed, acceleration, end_speed, shape)
+    return 0.5 / speeds
+
+
+@lru_cache(maxsize=256)
+def build_step_mask(required_steps):
+    """
+    Interleaves the steps of several axes Bresenham style so that every axis finishes on the last tick
+    and the combined motion is a straight line. The axis with the most steps steps on every tick.
+    :param required_steps: {tuple(int)} Steps required by each axis.
+    :return: {np.array} Boolean (axes, ticks) array that is True where an axis steps.
+    """
+    n_ticks = max(required_steps) if len(required_steps) > 0 else 0
+    ticks = np.arange(n_ticks, dtype=np.int64)
+    mask = np.zeros((len(required_steps), n_ticks), dtype=bool)
+    for i, n in enumerate(required_steps):
+        mask[i] = ((ticks + 1) * n) // n_ticks - (ticks * n) // n_ticks == 1
+    mask.flags.writeable = False
+    return mask
+
+
+def delay_to_speed(delay):
+    """
+    :param delay: Delay in seconds after each edge of a step.
+    :return: Step rate in steps/s.
+    """
+    return 0.5 / delay
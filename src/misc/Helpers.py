@@ -3,7 +3,11 @@ from src.misc.Log import log, Log
 from PIL import Image
 import numpy as np
 import cv2
+import json
 import os
+import tempfile
+import threading
+from collections import deque, OrderedDict
 
 import pathlib
 
@@ -12,6 +16,7 @@ RUNTIME_DIR_PATH = CURRENT_DIR.parent.parent.joinpath('runtime').absolute()
 CALIBRATION_DIR = RUNTIME_DIR_PATH.joinpath('calibration').absolute()
 IMAGES_DIR = RUNTIME_DIR_PATH.joinpath('images').absolute()
 LOG_DIR = RUNTIME_DIR_PATH.joinpath('logs').absolute()
+PHRASES_DIR = RUNTIME_DIR_PATH.joinpath('phrases').absolute()
 
 
 def ensure_runtime_dir_exists(func):
@@ -22,33 +27,177 @@ def ensure_runtime_dir_exists(func):
         for path in [RUNTIME_DIR_PATH, CALIBRATION_DIR, IMAGES_DIR, LOG_DIR]:
             if not os.path.exists(path):
                 os.mkdir(path)
-        func(*args, **kwargs)
+        return func(*args, **kwargs)
     return wrapper
 
 
-@ensure_runtime_dir_exists
-def cleanup_runtime_dir():
-    log.info('Cleaning up runtime directory')
-    image_retain_milliseconds = 1000 * 30
-    for filename in os.listdir(IMAGES_DIR):
-        timestamp = filename.split('.')[0].split('-')[0]
-        if timestamp.isnumeric():
-            timestamp = int(timestamp)
-            if Log.current_time_in_milliseconds() - timestamp < image_retain_milliseconds:
-                continue
-        image_path = str(IMAGES_DIR.joinpath(filename).absolute())
-        os.remove(image_path)
-        log.info(f"Removed image {filename} from runtime/images")
-    log_retain_milliseconds = 60 * 60 * 12 * 1000
-    for filename in os.listdir(LOG_DIR):
-        timestamp = filename.split('.')[0]
-        if timestamp.isnumeric():
-            timestamp = int(timestamp)
-            if Log.current_time_in_milliseconds() - timestamp < log_retain_milliseconds:
+class ArtifactStore:
+    """
+    Bounds the disk space used by images, logs and synthesized phrases in the runtime dir. Every file written is recorded in
+    an append only index with its size, so retention is enforced from the index as files are written
+    and the directories never have to be listed. Files of each kind are kept in least recently used
+    order. Files older than the age budget of their kind are removed, then the least recently used
+    files of any kind until the total size is within the byte budget. Calibration files are not recorded
+    and never removed.
+    """
+
+    KIND_IMAGE = 'image'
+    KIND_LOG = 'log'
+    KIND_PHRASE = 'phrase'
+
+    # Directories listed once to build the index when there is none yet
+    SEED_DIRECTORIES = {KIND_IMAGE: IMAGES_DIR, KIND_LOG: LOG_DIR, KIND_PHRASE: PHRASES_DIR}
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, max_ages=None):
+        self.index_path = RUNTIME_DIR_PATH.joinpath('index.jsonl')
+        self.lock = threading.RLock()
+        self.entries = None
+        self.total_bytes = 0
+        self.index_lines = 0
+        self.configure(max_bytes, max_ages)
+
+    def configure(self, max_bytes=512 * 1024 * 1024, max_ages=None):
+        """
+        :param max_bytes: Total size of the recorded files.
+        :param max_ages: {dict} Map of kind to the seconds files of that kind are kept for.
+        """
+        self.max_bytes = max_bytes
+        self.max_ages = {ArtifactStore.KIND_IMAGE: 60 * 60 * 12, ArtifactStore.KIND_LOG: 60 * 60 * 12,
+                         ArtifactStore.KIND_PHRASE: 60 * 60 * 24 * 30} if max_ages is None else max_ages
+
+    def load(self):
+        """
+        Replays the index. Only the index is read, the directories are only listed if there is no index.
+        """
+        self.entries = {}
+        self.total_bytes = 0
+        self.index_lines = 0
+        if not self.index_path.exists():
+            self.seed()
+            return
+        with open(self.index_path) as file:
+            for line in file:
+                self.index_lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._apply(record)
+
+    def seed(self):
+        """
+        Builds the index from the files already in the runtime dir, e.g. those written before the index
+        existed. Files are recorded in the order they were last modified.
+        """
+        records = []
+        for kind, directory in ArtifactStore.SEED_DIRECTORIES.items():
+            if not os.path.isdir(directory):
                 continue
-        log_path = str(LOG_DIR.joinpath(filename).absolute())
-        os.remove(log_path)
-        log.info(f"Removed image {filename} from runtime/logs")
+            for entry in os.scandir(directory):
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                records.append({'op': 'add', 'path': str(pathlib.Path(entry.path).absolute()), 'kind': kind,
+                                'size': stat.st_size, 'time': int(stat.st_mtime * 1000)})
+        if len(records) == 0:
+            return
+        log.info(f"Indexing {len(records)} existing files in runtime dir")
+        for record in sorted(records, key=lambda r: r['time']):
+            self._apply(record)
+        self.compact()
+
+    def _apply(self, record):
+        path = record['path']
+        for entries in self.entries.values():
+            if path in entries:
+                self.total_bytes -= entries.pop(path)['size']
+        if record['op'] == 'add':
+            self.entries.setdefault(record['kind'], OrderedDict())[path] = record
+            self.total_bytes += record['size']
+
+    @ensure_runtime_dir_exists
+    def _append(self, record):
+        self._apply(record)
+        with open(self.index_path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+        self.index_lines += 1
+
+    def record(self, path, kind):
+        """
+        Adds a written file to the index and enforces the budgets. Recording a file again marks it as
+        recently used and updates its size.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+            self._append({'op': 'add', 'path': str(path), 'kind': kind, 'size': size,
+                          'time': Log.current_time_in_milliseconds()})
+            self.enforce()
+
+    def enforce(self):
+        """
+        Removes files until the age and byte budgets are met.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            now = Log.current_time_in_milliseconds()
+            for kind, entries in self.entries.items():
+                max_age = self.max_ages.get(kind)
+                while max_age is not None and len(entries) > 0 \
+                        and now - next(iter(entries.values()))['time'] > max_age * 1000:
+                    self.evict(next(iter(entries)))
+            while self.total_bytes > self.max_bytes:
+                oldest = [next(iter(entries.values())) for entries in self.entries.values() if len(entries) > 0]
+                if len(oldest) == 0:
+                    break
+                self.evict(min(oldest, key=lambda entry: entry['time'])['path'])
+            if self.index_lines > 2 * sum(len(entries) for entries in self.entries.values()) + 100:
+                self.compact()
+
+    def evict(self, path):
+        try:
+            os.remove(path)
+            log.info(f"Removed {path} from runtime dir")
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            log.warn(f"Could not remove {path}: {error}")
+        self._append({'op': 'remove', 'path': path})
+
+    def compact(self):
+        """
+        Rewrites the index with only the files it still holds.
+        """
+        records = sorted([entry for entries in self.entries.values() for entry in entries.values()],
+                         key=lambda entry: entry['time'])
+        temporary_path = f"{self.index_path}.tmp"
+        with open(temporary_path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+        os.replace(temporary_path, self.index_path)
+        self.index_lines = len(records)
+
+
+artifact_store = ArtifactStore()
+
+
+def get_frame_path(camera=None, calibration=False, name=None, name_only=False, extension='jpg'):
+    """
+    Builds the path a frame is saved to in the runtime dir.
+    """
+    image_name = f"{Log.current_time_in_milliseconds()}"
+    if camera is not None:
+        image_name += f"-e{str(camera.exposure)[:6]}"
+    if name is not None:
+        image_name += f"-{name}"
+        if name_only:
+            image_name = name
+    return f"{CALIBRATION_DIR if calibration else IMAGES_DIR}/{image_name}.{extension}"
 
 
 @ensure_runtime_dir_exists
@@ -61,16 +210,166 @@ def save_frame_to_runtime_dir(frame, camera=None, calibration=False, name=None,
     :param camera: The camera object used to capture the frame.
     """
     data = Image.fromarray(frame)
-    image_name = f"{Log.current_time_in_milliseconds()}"
-    if camera is not None:
-        image_name += f"-e{str(camera.exposure)[:6]}"
-    if name is not None:
-        image_name += f"-{name}"
-        if name_only:
-            image_name = name
-    path = f"{CALIBRATION_DIR if calibration else IMAGES_DIR}/{image_name}.jpg"
+    path = get_frame_path(camera, calibration, name, name_only)
     log.info(f"Saving frame to {path}")
     data.save(path)
+    if not calibration:
+        artifact_store.record(path, ArtifactStore.KIND_IMAGE)
+
+
+class ArtifactWriter:
+    """
+    Saves debug frames to the runtime dir on a background thread. Frames wait in a bounded queue and the
+    oldest waiting frame is dropped when the queue is full, so callers never wait on annotation, encoding
+    or the disk. Frames handed to the writer must not be modified afterwards.
+    """
+
+    ENCODER_JPG = 'jpg'
+    ENCODER_PNG = 'png'
+    ENCODER_WEBP = 'webp'
+
+    def __init__(self, queue_size=8, encoder=ENCODER_JPG, quality=85, thumbnail_scale=None):
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.worker = None
+        self.busy = False
+        self.dropped = 0
+        self.configure(queue_size, encoder, quality, thumbnail_scale)
+
+    def configure(self, queue_size=8, encoder=ENCODER_JPG, quality=85, thumbnail_scale=None):
+        """
+        :param queue_size: Number of frames that may wait to be written.
+        :param encoder: {ENCODER_JPG}, {ENCODER_PNG} or {ENCODER_WEBP}.
+        :param quality: Quality from 0 to 100. For png it sets the compression level instead.
+        :param thumbnail_scale: If set, a thumbnail downscaled by this factor is saved next to each frame.
+        """
+        if encoder not in (ArtifactWriter.ENCODER_JPG, ArtifactWriter.ENCODER_PNG, ArtifactWriter.ENCODER_WEBP):
+            raise ValueError(f"Unknown encoder '{encoder}'.")
+        self.queue_size = queue_size
+        self.encoder = encoder
+        self.quality = quality
+        self.thumbnail_scale = thumbnail_scale
+
+    def get_encode_parameters(self):
+        if self.encoder == ArtifactWriter.ENCODER_JPG:
+            return [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)]
+        if self.encoder == ArtifactWriter.ENCODER_WEBP:
+            return [cv2.IMWRITE_WEBP_QUALITY, int(self.quality)]
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(round(9 - self.quality * 9 / 100))]
+
+    def submit(self, frame, camera=None, markers=None, board=None, name=None):
+        """
+        Queues a frame to be saved to the images dir. The file name is taken when the frame is submitted.
+        :param markers: Markers drawn onto the frame before it is saved.
+        :param board: Board used to label the markers.
+        """
+        path = get_frame_path(camera, name=name, extension=self.encoder)
+        with self.condition:
+            while len(self.queue) >= max(1, self.queue_size):
+                self.queue.popleft()
+                self.dropped += 1
+                log.warn(f"Artifact queue is full. Dropped a frame ({self.dropped} in total).")
+            self.queue.append((frame, markers, board, path))
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name='artifact-writer', daemon=True)
+                self.worker.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0:
+                    self.busy = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+                frame, markers, board, path = self.queue.popleft()
+                self.busy = True
+            try:
+                self.write(frame, markers, board, path)
+            except Exception as error:
+                log.error(f"Failed to save frame to {path}: {error}")
+
+    @ensure_runtime_dir_exists
+    def write(self, frame, markers, board, path):
+        if markers is not None:
+            draw_markers(frame, markers, board=board)
+        image = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        log.info(f"Saving frame to {path}")
+        cv2.imwrite(path, image, self.get_encode_parameters())
+        artifact_store.record(path, ArtifactStore.KIND_IMAGE)
+        if self.thumbnail_scale is not None:
+            thumbnail = cv2.resize(image, None, fx=1 / self.thumbnail_scale, fy=1 / self.thumbnail_scale,
+                                   interpolation=cv2.INTER_AREA)
+            root, extension = os.path.splitext(path)
+            cv2.imwrite(f"{root}-thumbnail{extension}", thumbnail, self.get_encode_parameters())
+            artifact_store.record(f"{root}-thumbnail{extension}", ArtifactStore.KIND_IMAGE)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued frame was written.
+        :return: {bool} False if the timeout passed first.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.queue) == 0 and not self.busy, timeout=timeout)
+
+
+artifact_writer = ArtifactWriter()
+
+
+@ensure_runtime_dir_exists
+def save_arrays_to_calibration_dir(name, **arrays):
+    """
+    Saves numpy arrays to a single .npz file in the calibration dir.
+    :param name: Name of the file without extension.
+    :param arrays: Named arrays to save.
+    """
+    path = f"{CALIBRATION_DIR}/{name}.npz"
+    log.info(f"Saving arrays to {path}")
+    np.savez(path, **arrays)
+
+
+def load_arrays_from_calibration_dir(name):
+    """
+    Loads arrays saved with {save_arrays_to_calibration_dir}.
+    :param name: Name of the file without extension.
+    :return: {dict} Map of array names to arrays or None if the file does not exist.
+    """
+    path = CALIBRATION_DIR.joinpath(f"{name}.npz")
+    if not path.exists():
+        return None
+    with np.load(str(path)) as data:
+        return {key: data[key] for key in data.files}
+
+
+@ensure_runtime_dir_exists
+def save_json_to_runtime_dir(name, data):
+    """
+    Saves data as json in the runtime dir. The data is written to a temporary file first so the file is
+    never left partially written.
+    :param name: Name of the file.
+    """
+    path = RUNTIME_DIR_PATH.joinpath(name)
+    # A unique temporary file per write so concurrent saves do not replace each other's file
+    with tempfile.NamedTemporaryFile('w', dir=RUNTIME_DIR_PATH, prefix=f"{name}.", suffix='.tmp', delete=False) as file:
+        json.dump(data, file)
+    os.replace(file.name, path)
+
+
+def load_json_from_runtime_dir(name):
+    """
+    Loads data saved with {save_json_to_runtime_dir}.
+    :param name: Name of the file.
+    :return: The data or None if the file does not exist or cannot be read.
+    """
+    path = RUNTIME_DIR_PATH.joinpath(name)
+    if not path.exists():
+        return None
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError) as error:
+        log.warn(f"Could not load {path}: {error}")
+        return None
 
 
 def draw_markers(frame, markers, board=None, point_only=False, primary_color=(100, 255, 0), secondary_color=(150, 150, 255)):
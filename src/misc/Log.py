@@ -1,16 +1,61 @@
+import atexit
+import json
+import os
+import threading
 import time
+from collections import deque
 
 
 class Log:
     """
     Logging class for debugging and monitoring.
+    Logging a message only appends a record to an in memory ring buffer. A background thread formats the
+    records, prints them and writes them to the log file as JSON lines, so logging does not block the
+    calling thread on the console or the disk. Messages may be given with %-style args that are only
+    formatted on the background thread.
     """
 
+    DEBUG = 10
+    INFO = 20
+    WARN = 30
+    ERROR = 40
+
+    LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARN: 'WARN', ERROR: 'ERROR'}
+    CONSOLE_FORMATS = {
+        DEBUG: "\033[35m[DEBUG]\033[0m \033[37m({elapsed}ms)\033[0m {message}",
+        INFO: "\033[32m[INFO]\033[0m \033[37m({elapsed}ms)\033[0m {message}",
+        WARN: "\033[33m[WARN] \033[37m({elapsed}ms)\033[0m {message}\033[0m",
+        ERROR: "\033[31m[ERROR] \033[37m({elapsed}ms)\033[0m {message}\033[0m",
+    }
+
     log_info = True
     init_time = time.time()
     save_output = False
     file = None
 
+    def __init__(self, level=DEBUG, buffer_size=10000, flush_interval=0.1, max_file_bytes=8 * 1024 * 1024):
+        """
+        :param level: Records below this level are discarded.
+        :param buffer_size: Number of records the ring buffer holds. The oldest records are dropped when it is full.
+        :param flush_interval: Seconds between writes of the buffered records.
+        :param max_file_bytes: Size after which a new log file is started.
+        """
+        self.level = level
+        self.buffer = deque(maxlen=buffer_size)
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.directory = None
+        self.file_index = 0
+        self.file_bytes = 0
+        self.on_file_closed = None
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.flusher = None
+        atexit.register(self.flush)
+
+    def set_level(self, level):
+        self.level = level
+
     def elapsed_time(self):
         return f"\033[37m({self.elapsed_time_raw()}ms)\033[0m"
 
@@ -20,38 +65,124 @@ class Log:
         """
         return int((time.time() - self.init_time) * 1000)
 
-    def enable_save_output(self, path):
+    def enable_save_output(self, path, on_file_closed=None):
+        """
+        Writes the log to files in the directory.
+        :param on_file_closed: Called with the path of each log file once it is complete.
+        """
+        self.flush()
+        self.directory = path
+        self.on_file_closed = on_file_closed
         self.save_output = True
-        self.file = open(f"{path}/{Log.current_time_in_milliseconds()}.log", 'a+')
+        self.open_file()
+
+    def open_file(self):
+        suffix = '' if self.file_index == 0 else f"-{self.file_index}"
+        self.file = open(f"{self.directory}/{Log.current_time_in_milliseconds()}{suffix}.jsonl", 'a+')
+        self.file_bytes = self.file.tell()
 
     def close_file(self):
+        self.flush()
+        self.save_output = False
+        self._close_current_file()
+
+    def _close_current_file(self):
+        if self.file is None or self.file.closed:
+            return
         self.file.close()
+        if self.on_file_closed is not None:
+            self.on_file_closed(self.file.name)
 
     @staticmethod
     def current_time_in_milliseconds():
         return int(time.time() * 1000)
 
-    def info(self, message):
+    def info(self, message, *args):
         if not self.log_info:
             return
-        self.write_line(f"\033[32m[INFO]\033[0m {self.elapsed_time()} {message}")
+        self.log(Log.INFO, message, *args)
 
-    def warn(self, message):
-        self.write_line(f"\033[33m[WARN] {self.elapsed_time()} {message}\033[0m")
+    def warn(self, message, *args):
+        self.log(Log.WARN, message, *args)
 
-    def error(self, message):
-        self.write_line(f"\033[31m[ERROR] {self.elapsed_time()} {message}\033[0m")
+    def error(self, message, *args):
+        self.log(Log.ERROR, message, *args)
 
-    def debug(self, message):
-        self.write_line(f"\033[35m[DEBUG]\033[0m {self.elapsed_time()} {message}")
+    def debug(self, message, *args):
+        self.log(Log.DEBUG, message, *args)
+
+    def log(self, level, message, *args):
+        """
+        Adds a record to the ring buffer. The message is formatted with the args on the background thread.
+        """
+        if level < self.level:
+            return
+        self.buffer.append((time.time(), level, message, args, threading.current_thread().name))
+        if self.flusher is None:
+            self._start_flusher()
+        if level >= Log.ERROR:
+            self.wake.set()
+
+    def _start_flusher(self):
+        with self.flush_lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self._run_flusher, name='log-flusher', daemon=True)
+            self.flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Prints and writes every buffered record.
+        """
+        with self.flush_lock:
+            lines, records = [], []
+            while len(self.buffer) > 0:
+                try:
+                    timestamp, level, message, args, thread = self.buffer.popleft()
+                except IndexError:
+                    break
+                if len(args) > 0:
+                    try:
+                        message = message % args
+                    except (TypeError, ValueError):
+                        message = ' '.join(str(x) for x in (message,) + args)
+                elapsed = int((timestamp - self.init_time) * 1000)
+                lines.append(Log.CONSOLE_FORMATS[level].format(elapsed=elapsed, message=message))
+                if self.save_output:
+                    records.append(json.dumps({
+                        'time': int(timestamp * 1000),
+                        'elapsed': elapsed,
+                        'level': Log.LEVEL_NAMES[level],
+                        'thread': thread,
+                        'message': str(message)
+                    }))
+            if len(lines) > 0:
+                print('\n'.join(lines), flush=True)
+            if len(records) > 0 and self.file is not None and not self.file.closed:
+                self._write_records(records)
+
+    def _write_records(self, records):
+        data = '\n'.join(records) + '\n'
+        self.file.write(data)
+        self.file.flush()
+        self.file_bytes += len(data)
+        # Start a new file once the current one is too large
+        if self.file_bytes >= self.max_file_bytes:
+            self._close_current_file()
+            self.file_index += 1
+            self.open_file()
 
     def write_line(self, line):
-        if self.save_output:
-            stripped_line = line
-            for x in [0, 31, 33, 32, 35, 37]:
-                stripped_line = stripped_line.replace(f"\033[{x}m", '')
-            self.file.write(stripped_line + '\n')
-        print(line)
+        """
+        Logs a preformatted line.
+        """
+        self.log(Log.INFO, '%s', line)
 
 
 # Global log available for use
@@ -0,0 +1,100 @@
+import numpy as np
+
+from src.misc.Helpers import save_json_to_runtime_dir, load_json_from_runtime_dir
+from src.misc.Log import log
+
+
+class Graveyard:
+    """
+    Grid of slots off the board where captured pieces are placed. Tracks which piece sits in each slot
+    so pieces can be brought back for promotions and when setting up the board. The contents are saved
+    to the runtime dir so they survive restarts.
+    """
+
+    def __init__(self, origin, columns, rows, spacing, state_file=None):
+        """
+        :param origin: (x, y) Gantry position of the first slot.
+        :param columns: Number of slot columns.
+        :param rows: Number of slot rows.
+        :param spacing: (x, y) Gantry distance between neighbouring slots.
+        :param state_file: Name of the file in the runtime dir the contents are saved to. None to not save them.
+        """
+        self.slot_locations = np.array([
+            (origin[0] + c * spacing[0], origin[1] + r * spacing[1]) for c in range(columns) for r in range(rows)
+        ], dtype=np.float64)
+        self.slot_locations.flags.writeable = False
+        self.contents = [None] * len(self.slot_locations)
+        self.state_file = state_file
+        self.load()
+
+    def get_slot_location(self, slot):
+        x, y = self.slot_locations[slot]
+        return int(x), int(y)
+
+    def get_free_slots(self):
+        return [slot for slot, piece in enumerate(self.contents) if piece is None]
+
+    def allocate(self, route_start, route_end):
+        """
+        Picks the free slot that adds the least travel to a trip from {route_start} to {route_end}, for
+        example from the captured piece to the start of the move.
+        :return: The slot or None if the graveyard is full.
+        """
+        free_slots = self.get_free_slots()
+        if len(free_slots) == 0:
+            return None
+        locations = self.slot_locations[free_slots]
+        detours = np.linalg.norm(locations - np.array(route_start), axis=1) \
+            + np.linalg.norm(locations - np.array(route_end), axis=1)
+        return free_slots[int(np.argmin(detours))]
+
+    def find(self, piece, near=None):
+        """
+        :param near: (x, y) Location to prefer slots close to.
+        :return: The slot holding the piece or None if the graveyard does not hold the piece.
+        """
+        slots = [slot for slot, p in enumerate(self.contents) if p == piece]
+        if len(slots) == 0:
+            return None
+        if near is None:
+            return slots[0]
+        distances = np.linalg.norm(self.slot_locations[slots] - np.array(near), axis=1)
+        return slots[int(np.argmin(distances))]
+
+    def place(self, slot, piece):
+        if self.contents[slot] is not None:
+            log.warn(f"Graveyard slot {slot} already holds {self.contents[slot]}.")
+        self.contents[slot] = piece
+        self.save()
+
+    def take(self, slot):
+        """
+        :return: The piece that was in the slot.
+        """
+        piece = self.contents[slot]
+        self.contents[slot] = None
+        self.save()
+        return piece
+
+    def clear(self):
+        """
+        Marks every slot as empty, e.g. after the pieces were removed by hand.
+        """
+        self.contents = [None] * len(self.slot_locations)
+        self.save()
+
+    def load(self):
+        if self.state_file is None:
+            return
+        contents = load_json_from_runtime_dir(self.state_file)
+        if contents is None:
+            return
+        if len(contents) != len(self.contents):
+            log.warn('Saved graveyard does not match the configured slots. Assuming it is empty.')
+            return
+        self.contents = contents
+        log.info(f"Graveyard holds {''.join(p for p in contents if p is not None)}")
+
+    def save(self):
+        if self.state_file is not None:
+            save_json_to_runtime_dir(self.state_file, self.contents)
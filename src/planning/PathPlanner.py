@@ -0,0 +1,199 @@
+import heapq
+import math
+
+from src.misc.Log import log
+
+
+# The planner works on a grid with half square resolution. Node (x, y) with even coordinates is the
+# center of square (x / 2, y / 2); odd coordinates lie on the lines between squares.
+GRID_SIZE = 15
+
+DIRECTIONS_ORTHOGONAL = ((1, 0), (-1, 0), (0, 1), (0, -1))
+DIRECTIONS_DIAGONAL = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+def sid_to_node(sid):
+    """
+    :param sid: Square id, e.g. 'e4'.
+    :return: (x, y) grid node at the center of the square.
+    """
+    return 2 * (ord(sid[0]) - ord('a')), 2 * (int(sid[1]) - 1)
+
+
+def node_to_grid_point(node):
+    """
+    :param node: (x, y) grid node.
+    :return: (col, row) position in squares where (0, 0) is the center of a1.
+    """
+    return node[0] / 2, node[1] / 2
+
+
+def get_touched_squares(node):
+    """
+    :return: List of (col, row) squares that a piece centered on the node overlaps.
+    """
+    x, y = node
+    cols = [x // 2] if x % 2 == 0 else [(x - 1) // 2, (x + 1) // 2]
+    rows = [y // 2] if y % 2 == 0 else [(y - 1) // 2, (y + 1) // 2]
+    return [(c, r) for c in cols for r in rows]
+
+
+# Squares overlapped by each node, precomputed once for all nodes
+TOUCHED_SQUARES = {
+    (x, y): get_touched_squares((x, y)) for x in range(GRID_SIZE) for y in range(GRID_SIZE)
+}
+
+
+def _octile_distance(a, b, diagonal):
+    dx, dy = abs(a[0] - b[0]), abs(a[1] - b[1])
+    if not diagonal:
+        return dx + dy
+    return max(dx, dy) + (math.sqrt(2) - 1) * min(dx, dy)
+
+
+# Precomputed distance heuristics keyed by (goal, allow_diagonal)
+_heuristic_tables = {}
+
+
+def get_heuristic_table(goal, diagonal):
+    """
+    :return: {dict} Map of node to the lower bound travel distance in squares to the goal.
+    """
+    key = (goal, diagonal)
+    if key not in _heuristic_tables:
+        _heuristic_tables[key] = {
+            node: _octile_distance(node, goal, diagonal) / 2 for node in TOUCHED_SQUARES
+        }
+    return _heuristic_tables[key]
+
+
+def _is_on_ray(node, direction, goal):
+    """
+    :return: {bool} True if the goal can be reached from the node by travelling straight in the direction.
+    """
+    dx, dy = goal[0] - node[0], goal[1] - node[1]
+    if (dx, dy) == (0, 0):
+        return True
+    if direction[0] * dy != direction[1] * dx:
+        return False
+    return dx * direction[0] >= 0 and dy * direction[1] >= 0
+
+
+class PathPlanner:
+    """
+    A* path planner for sliding a piece across the board without touching other pieces.
+    Path cost is the travelled distance in squares plus {turn_penalty} for every change of
+    direction, so with a large penalty the path with the fewest turns is returned.
+    """
+
+    def __init__(self, turn_penalty=64, allow_diagonal=False, allow_between_squares=False, max_turns=None):
+        """
+        :param turn_penalty: Cost added for each change of direction.
+        :param allow_diagonal: Allow moving diagonally between squares.
+        :param allow_between_squares: Allow travelling along the lines between squares.
+        :param max_turns: Reject paths with more turns than this. None for no limit.
+        """
+        self.turn_penalty = turn_penalty
+        self.allow_diagonal = allow_diagonal
+        self.allow_between_squares = allow_between_squares
+        self.max_turns = max_turns
+        self.directions = DIRECTIONS_ORTHOGONAL + (DIRECTIONS_DIAGONAL if allow_diagonal else ())
+        self.step = 1 if allow_between_squares else 2
+
+    @staticmethod
+    def get_occupancy_grid(board_state, ignored_sids=()):
+        """
+        :return: 8x8 grid indexed [col][row] that is True where a square is occupied.
+        """
+        grid = [[False] * 8 for _ in range(8)]
+        for sid in board_state:
+            if sid in ignored_sids:
+                continue
+            col, row = sid_to_node(sid)
+            grid[col // 2][row // 2] = True
+        return grid
+
+    @staticmethod
+    def is_node_clear(node, grid):
+        return not any(grid[c][r] for c, r in TOUCHED_SQUARES[node])
+
+    def plan(self, s_sid, e_sid, board_state):
+        """
+        Finds the path with the lowest cost from s_sid to e_sid that does not pass over any other piece.
+        The start and end squares are treated as clear.
+        :param s_sid: The square the piece starts on.
+        :param e_sid: The square the piece ends on.
+        :param board_state: {dict} Map of sids to pieces.
+        :return: List of (col, row) waypoints where the path turns, ending at e_sid, or None if there is no path.
+        """
+        start, goal = sid_to_node(s_sid), sid_to_node(e_sid)
+        if start == goal:
+            return []
+        grid = PathPlanner.get_occupancy_grid(board_state, ignored_sids=(s_sid, e_sid))
+        heuristic = get_heuristic_table(goal, self.allow_diagonal)
+        # States are (node, direction). The start state has no direction so the first move is not a turn.
+        start_state = (start, None)
+        g_costs = {start_state: 0}
+        turn_counts = {start_state: 0}
+        parents = {start_state: None}
+        counter = 0
+        open_heap = [(heuristic[start] + (0 if self._is_aligned(start, goal) else self.turn_penalty),
+                      counter, start_state)]
+        closed = set()
+        while len(open_heap) > 0:
+            _, _, state = heapq.heappop(open_heap)
+            if state in closed:
+                continue
+            closed.add(state)
+            node, direction = state
+            if node == goal:
+                return self._reconstruct(state, parents)
+            for d in self.directions:
+                # Do not reverse back over the path
+                if direction is not None and d == (-direction[0], -direction[1]):
+                    continue
+                next_node = (node[0] + d[0] * self.step, node[1] + d[1] * self.step)
+                if not (0 <= next_node[0] < GRID_SIZE and 0 <= next_node[1] < GRID_SIZE):
+                    continue
+                # Every node passed over during the step must be clear
+                if not all(PathPlanner.is_node_clear((node[0] + d[0] * i, node[1] + d[1] * i), grid)
+                           for i in range(1, self.step + 1)):
+                    continue
+                turned = direction is not None and d != direction
+                turns = turn_counts[state] + (1 if turned else 0)
+                if self.max_turns is not None and turns > self.max_turns:
+                    continue
+                next_state = (next_node, d)
+                g = g_costs[state] + self.step / 2 * (math.sqrt(2) if d[0] and d[1] else 1) \
+                    + (self.turn_penalty if turned else 0)
+                if next_state in g_costs and g_costs[next_state] <= g:
+                    continue
+                g_costs[next_state] = g
+                turn_counts[next_state] = turns
+                parents[next_state] = state
+                h = heuristic[next_node] + (0 if _is_on_ray(next_node, d, goal) else self.turn_penalty)
+                counter += 1
+                heapq.heappush(open_heap, (g + h, counter, next_state))
+        log.info(f"No clear path from {s_sid} to {e_sid}.")
+        return None
+
+    def _is_aligned(self, node, goal):
+        return any(_is_on_ray(node, d, goal) for d in self.directions)
+
+    @staticmethod
+    def _reconstruct(state, parents):
+        """
+        Walks back through the parents and returns the nodes where the direction changes.
+        """
+        states = []
+        while state is not None:
+            states.append(state)
+            state = parents[state]
+        states.reverse()
+        waypoints = []
+        for i in range(1, len(states)):
+            node, direction = states[i]
+            is_last = i == len(states) - 1
+            if is_last or states[i + 1][1] != direction:
+                waypoints.append(node_to_grid_point(node))
+        return waypoints
@@ -0,0 +1,139 @@
+import numpy as np
+
+from src.misc.Log import log
+from src.tracking.BoardState import BoardState
+
+
+def solve_assignment(cost):
+    """
+    Hungarian algorithm. Finds the assignment of rows to columns with the lowest total cost.
+    :param cost: {np.array} (rows, cols) cost matrix. Rectangular matrices assign min(rows, cols) pairs.
+    :return: {[(row, col)]} Assigned pairs.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return []
+    # Potentials and matching use 1 based indices with column 0 as the virtual start
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        min_values = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < min_values[1:])
+            min_values[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, min_values[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            min_values[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0 != 0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    pairs = [(p[j] - 1, j - 1) for j in range(1, m + 1) if p[j] != 0]
+    return [(c, r) for r, c in pairs] if transposed else pairs
+
+
+class SetupPlanner:
+    """
+    Plans the moves that bring the board from its current state to a target state with as little gantry
+    travel as possible. Pieces are assigned to target squares of the same piece by minimum cost
+    assignment, where every piece that has to move costs {move_cost} on top of its travel distance so
+    pieces already in place are left alone. Moves are then ordered greedily by the travel from where
+    the previous move ended, and cycles of pieces blocking each other are broken through free squares.
+    """
+
+    def __init__(self, board, move_cost=0):
+        """
+        :param board: {Board} Board providing the distances between squares.
+        :param move_cost: Cost of a pick and place cycle in gantry distance units.
+        """
+        self.board = board
+        self.move_cost = move_cost
+
+    def distance(self, sid_a, sid_b):
+        return self.board.get_square_distance(sid_a, sid_b)
+
+    def assign(self, board_state, target_state):
+        """
+        :return: ({[(s_sid, e_sid)]} moves, {[sid]} sids of surplus pieces that are not in the target state)
+        """
+        moves, surplus = [], []
+        for piece in sorted(set(board_state.values()) | set(target_state.values())):
+            sources = [sid for sid, p in board_state.items() if p == piece]
+            targets = [sid for sid, p in target_state.items() if p == piece]
+            cost = np.array([[0 if s == t else self.distance(s, t) + self.move_cost for t in targets]
+                             for s in sources]).reshape(len(sources), len(targets))
+            pairs = solve_assignment(cost)
+            assigned = {sources[i] for i, _ in pairs}
+            moves += [(sources[i], targets[j]) for i, j in pairs if sources[i] != targets[j]]
+            surplus += [sid for sid in sources if sid not in assigned]
+            if len(targets) > len(sources):
+                log.warn(f"Missing {len(targets) - len(sources)} '{piece}' piece(s) to set up the board.")
+        return moves, surplus
+
+    def plan(self, board_state, target_state, start_sid=None):
+        """
+        :param board_state: {dict} Current board state.
+        :param target_state: {dict} Board state to reach.
+        :param start_sid: Square the gantry starts at, None if unknown.
+        :return: {[str]} Moves in s_sid e_sid form in the order they should be made.
+        """
+        board_state = BoardState(board_state)
+        moves, surplus = self.assign(board_state, target_state)
+        # Surplus pieces standing on target squares have to be moved out of the way
+        target_sids = set(target_state)
+        parking = [(sid, None) for sid in surplus if sid in target_sids]
+        pending = moves + parking
+        ordered = []
+        position = start_sid
+        while len(pending) > 0:
+            free_sids = [sid for sid in self.board.sid_index if sid not in board_state]
+            parking_sids = [sid for sid in free_sids if sid not in target_sids] or free_sids
+            ready = [(s, e) for s, e in pending if e is None or e not in board_state]
+            if len(ready) > 0:
+                s_sid, e_sid = min(ready, key=lambda m: self.get_move_cost(position, m, parking_sids))
+                pending.remove((s_sid, e_sid))
+                if e_sid is None:
+                    e_sid = min(parking_sids, key=lambda f: self.distance(s_sid, f))
+            else:
+                # Every remaining move ends on an occupied square, so move a piece of a cycle to a free square
+                s_sid, e_sid = min(pending, key=lambda m: self.get_move_cost(position, m, parking_sids))
+                pending.remove((s_sid, e_sid))
+                f_sid = min(parking_sids, key=lambda f: self.distance(s_sid, f) + self.distance(f, e_sid))
+                log.info(f"Breaking cycle by moving {s_sid} to {f_sid}.")
+                pending.append((f_sid, e_sid))
+                e_sid = f_sid
+            ordered.append(f"{s_sid}{e_sid}")
+            board_state[e_sid] = board_state.pop(s_sid)
+            position = e_sid
+        log.info(f"Setup plan: {ordered}")
+        return ordered
+
+    def get_move_cost(self, position, move, parking_sids):
+        """
+        :return: Travel to the start of the move plus the length of the move.
+        """
+        s_sid, e_sid = move
+        travel = 0 if position is None else self.distance(position, s_sid)
+        if e_sid is None:
+            return travel + min(self.distance(s_sid, f) for f in parking_sids)
+        return travel + self.distance(s_sid, e_sid)
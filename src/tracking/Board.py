@@ -1,7 +1,9 @@
 import numpy as np
 import math
+from types import MappingProxyType
 from src.misc.Exceptions import BoardPieceViolation, NoMoveFound, InvalidMove
 from src.misc.Log import log
+from src.tracking.BoardState import BoardState
 from stockfish import Stockfish
 
 
@@ -17,45 +19,63 @@ class Board:
         self.h1_position = np.array(h1_position)
         self.a8_position = np.array(a8_position)
         self.h8_position = np.array(h8_position)
+        # Lookup tables for square locations and the distances between them
+        sids = Board.get_all_sids()
+        self.sid_index = MappingProxyType({sid: i for i, sid in enumerate(sids)})
+        self.square_locations = MappingProxyType({
+            sid: self.interpolate_location(ord(sid[0]) - ord('a'), int(sid[1]) - 1) for sid in sids
+        })
+        # Locations at half square resolution for paths that travel between squares
+        self.grid_locations = MappingProxyType({
+            (col / 2, row / 2): self.interpolate_location(col / 2, row / 2) for col in range(15) for row in range(15)
+        })
+        locations = np.array([self.square_locations[sid] for sid in sids], dtype=np.float64)
+        self.square_distances = np.linalg.norm(locations[:, np.newaxis, :] - locations[np.newaxis, :, :], axis=2)
+        self.square_distances.flags.writeable = False
 
     def translate_fid_to_piece(self, fid):
         if fid not in self.fid_to_piece_map:
             raise BoardPieceViolation(f"Unknown piece {fid} detected on board.")
         return self.fid_to_piece_map[fid]
 
+    def interpolate_location(self, col, row):
+        """
+        Interpolates the gantry location of a point on the board from the known corner square positions.
+        :param col: Column where 0 is the a file and 7 is the h file.
+        :param row: Row where 0 is the first rank and 7 is the eighth rank.
+        :return: (x, y)
+        """
+        tx = self.a8_position + (self.h8_position - self.a8_position) * (1 / 7 * col)
+        bx = self.a1_position + (self.h1_position - self.a1_position) * (1 / 7 * col)
+        x, y = bx + (tx - bx) * (1 / 7 * row)
+        return int(x), int(y)
+
     def get_square_location(self, sid):
-        if len(sid) != 2:
-            log.error(f"Square ID \"{sid}\" is invalid. Returning (0, 0).")
-            return 0, 0
-        col, row = sid
-        col, row = int(ord(col) - ord('a')), int(row) - 1
-        if 0 <= col < 8 and 0 <= row < 8:
-            tx = self.a8_position + (self.h8_position - self.a8_position) * (1 / 7 * col)
-            bx = self.a1_position + (self.h1_position - self.a1_position) * (1 / 7 * col)
-            x, y = bx + (tx - bx) * (1 / 7 * row)
-            return [int(x), int(y)]
-        log.error(f"Square ID \"{sid}\" is out of bounds. Returning (0, 0).")
-        return [0, 0]
+        if sid in self.square_locations:
+            return self.square_locations[sid]
+        log.error(f"Square ID \"{sid}\" is invalid. Returning (0, 0).")
+        return 0, 0
+
+    def get_grid_location(self, col, row):
+        """
+        Returns the location of a point on the board given in squares where (0, 0) is the center of a1.
+        :param col: Column, may be a half step between squares.
+        :param row: Row, may be a half step between squares.
+        :return: (x, y)
+        """
+        if (col, row) in self.grid_locations:
+            return self.grid_locations[(col, row)]
+        return self.interpolate_location(col, row)
+
+    def get_square_distance(self, sid_a, sid_b):
+        """
+        :return: {float} Distance between the gantry locations of the two squares.
+        """
+        return self.square_distances[self.sid_index[sid_a], self.sid_index[sid_b]]
 
     @staticmethod
     def board_state_to_fen(square_ids):
-        fen = ""
-        em_count = 0
-        for sid in [f"{c}{r}" for r in range(8, 0, -1) for c in 'abcdefgh']:
-            if sid in square_ids:
-                if em_count > 0:
-                    fen += f"{em_count}"
-                    em_count = 0
-                fen += square_ids[sid]
-            else:
-                em_count += 1
-            if 'h' in sid:
-                if em_count > 0:
-                    fen += f"{em_count}"
-                    em_count = 0
-                fen += '/'
-        fen = fen[:-1] + ' b - - 0 1'
-        return fen
+        return BoardState.of(square_ids).to_fen() + ' b - - 0 1'
 
     @staticmethod
     def generate_chess_engine_instance():
@@ -63,46 +83,30 @@ class Board:
 
     @staticmethod
     def fen_to_board_state(fen):
-        board_layout = fen.split()[0]
-        for x in range(1, 9):
-            board_layout = board_layout.replace(str(x), ''.join(['0' for _ in range(x)]))
-        board_layout = board_layout.split('/')
-        board_layout = list(map(lambda r: list(r), board_layout))
-        square_ids = {}
-        letters = list('abcdefgh')
-        for i in range(8):
-            for j in range(8):
-                piece_id = board_layout[i][j]
-                if piece_id == '0':
-                    continue
-                square_ids[f"{letters[j]}{8 - i}"] = piece_id
-        return square_ids
+        return BoardState.from_fen(fen)
 
     @staticmethod
     def get_move_from_board_states(board_state_before, board_state_after, previous_moves, chess_engine: Stockfish):
         """
         Determine the move given the state before the move and the state after the move.
         """
-        # Determine the sids in the prev state that differ in the current state
-        changed_before = [sid for sid in board_state_before
-                          if sid not in board_state_after or board_state_after[sid] != board_state_before[sid]]
-        # Determine the sids in the current state that differ from the prev state
-        changed_after = [sid for sid in board_state_after
-                         if sid not in board_state_before or board_state_after[sid] != board_state_before[sid]]
-        # Check for promoted pieces
+        board_state_before = BoardState.of(board_state_before)
+        board_state_after = BoardState.of(board_state_after)
+        # Determine the sids that differ between the states, split by whether they were occupied before and after
+        changed = board_state_before.diff(board_state_after)
+        changed_before = [sid for sid in changed if sid in board_state_before]
+        changed_after = [sid for sid in changed if sid in board_state_after]
+        # Check for promoted pieces by comparing the number of each white piece
         promoted_piece = None
-        pieces_before = ''.join(sorted([p for p in board_state_before.values() if p in Board.get_white_pieces()]))
-        pieces_after = ''.join(sorted([p for p in board_state_after.values() if p in Board.get_white_pieces()]))
-        if pieces_before != pieces_after:
-            differing_pieces = pieces_before + pieces_after
-            for p in pieces_before:
-                if p in pieces_after:
-                    differing_pieces.replace(p, '', 2)
-            log.info(f"Found differing pieces between states: {differing_pieces}")
-            potential_piece = differing_pieces.replace('p', '')
-            if len(differing_pieces) != 2 or 'p' not in differing_pieces or len(potential_piece) != 1:
+        white_pieces = np.frombuffer(Board.get_white_pieces().encode(), dtype=np.uint8)
+        difference = (board_state_after.count_pieces() - board_state_before.count_pieces())[white_pieces]
+        if np.any(difference != 0):
+            removed = ''.join(p * -n for p, n in zip(Board.get_white_pieces(), difference) if n < 0)
+            added = ''.join(p * n for p, n in zip(Board.get_white_pieces(), difference) if n > 0)
+            log.info(f"Found differing pieces between states: removed {removed}, added {added}")
+            if removed != 'P' or len(added) != 1:
                 raise InvalidMove('Piece promotion is invalid.')
-            promoted_piece = potential_piece
+            promoted_piece = added
         # If no change raise exception
         if len(changed_before) == 0 or len(changed_after) == 0:
             raise NoMoveFound()
@@ -131,7 +135,8 @@ class Board:
                 raise InvalidMove('Move affected too many sids.')
         # Get the move end sid
         e_sid = changed_after[0]
-        piece_moved = board_state_after[e_sid] if promoted_piece is None else promoted_piece
+        # A promoted piece started the move as a pawn
+        piece_moved = board_state_after[e_sid] if promoted_piece is None else 'P'
         # Find the move start sid
         s_sid = None
         for sid in changed_before:
@@ -139,7 +144,7 @@ class Board:
                 s_sid = sid
         if s_sid is None:
             raise InvalidMove('Could not find move start.')
-        move = f"{s_sid}{e_sid}{promoted_piece if promoted_piece is not None else ''}"
+        move = f"{s_sid}{e_sid}{promoted_piece.lower() if promoted_piece is not None else ''}"
         # Verify that the move is valid
         chess_engine.set_position(previous_moves)
         if not chess_engine.is_move_correct(move):
@@ -203,18 +208,38 @@ class KeyPosition:
         self.sid_fid_mapping = sid_fid_mapping
         self.x_range = x_range
         self.y_range = y_range
+        # Square centers as an (N, 2) array so lookups can be vectorized
+        self.sids = list(sid_centers.keys())
+        self.center_array = np.array([sid_centers[sid] for sid in self.sids], dtype=np.float64)
+        self.square_spacing = self.get_square_spacing()
+
+    def get_square_spacing(self):
+        """
+        :return: {float} Median distance between neighbouring square centers in pixels.
+        """
+        if len(self.sids) < 2:
+            return math.inf
+        deltas = self.center_array[:, np.newaxis, :] - self.center_array[np.newaxis, :, :]
+        distances = np.linalg.norm(deltas, axis=2)
+        np.fill_diagonal(distances, math.inf)
+        return float(np.median(distances.min(axis=1)))
+
+    def get_closest_sids(self, positions):
+        """
+        Assigns each position to the square with the closest center.
+        :param positions: List of (x, y) positions.
+        :return: ({[str]} sids, {np.array} distances) The closest sid and the distance to it for each position.
+        """
+        if len(positions) == 0:
+            return [], np.zeros(0)
+        points = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        distances = np.linalg.norm(points[:, np.newaxis, :] - self.center_array[np.newaxis, :, :], axis=2)
+        indices = distances.argmin(axis=1)
+        return [self.sids[i] for i in indices], distances[np.arange(len(indices)), indices]
 
     def get_closest_sid(self, pos):
         """
         Returns the SID of the square that is closest to the position.
         """
-        x, y = pos
-        closest_sid = list(self.sid_centers.keys())[0]
-        closest_distance = math.inf
-        for sid in self.sid_centers:
-            sid_x, sid_y = self.sid_centers[sid]
-            distance = np.linalg.norm(np.array([sid_x, sid_y]) - np.array([x, y]))
-            if closest_distance > distance:
-                closest_distance = distance
-                closest_sid = sid
-        return closest_sid
+        sids, _ = self.get_closest_sids([pos])
+        return sids[0]
@@ -0,0 +1,204 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.misc.Exceptions import BoardPieceViolation
+from src.misc.Helpers import artifact_writer
+from src.misc.Log import log
+from src.tracking.BoardState import BoardState
+from src.tracking.Marker import Marker
+
+
+def filter_markers_by_range(markers, x_range, y_range):
+    return list(filter(
+        lambda m: (x_range[0] <= m.center[0] <= x_range[1]) and (y_range[0] <= m.center[1] <= y_range[1]),
+        markers
+    ))
+
+
+def filter_markers_by_id(markers, valid_ids):
+    return list(filter(
+        lambda m: m.id in valid_ids,
+        markers
+    ))
+
+
+class BoardScanner:
+    """
+    Scans the board through every key position as a pipeline. While the frame of one key position is
+    analyzed on the worker pool, the gantry travels to the next key position and captures it.
+    """
+
+    STAGE_TRAVEL = 'travel'
+    STAGE_CAPTURE = 'capture'
+    STAGE_DETECT = 'detect'
+    STAGE_ASSIGN = 'assign'
+    STAGE_TOTAL = 'total'
+
+    def __init__(self, gantry, camera, board, key_positions, fcc_map, roi_undistortion=True, roi_scale=1,
+                 detection_workers=2):
+        """
+        :param gantry: {Gantry} Gantry used to travel between key positions.
+        :param camera: {Camera} Camera to capture frames with.
+        :param board: {Board} Board used to translate fids to pieces.
+        :param key_positions: {[KeyPosition]} Key positions to scan in order.
+        :param fcc_map: {dict} Fid correction coefficients.
+        :param roi_undistortion: Only correct distortion within the key position regions.
+        :param roi_scale: Factor regions are resized by before marker detection.
+        :param detection_workers: Number of frames analyzed concurrently.
+        """
+        self.gantry = gantry
+        self.camera = camera
+        self.board = board
+        self.key_positions = key_positions
+        self.fcc_map = fcc_map
+        self.roi_undistortion = roi_undistortion
+        self.roi_scale = roi_scale
+        self.pool = ThreadPoolExecutor(max_workers=detection_workers, thread_name_prefix='board-scanner')
+
+    def adjust_markers(self, markers):
+        """
+        Adjusts the markers based on the fid correction coefficient matrix.
+        :param markers: {list(markers)} List of markers
+        :return: Adjusted markers
+        """
+        frame_center = np.array([x / 2 for x in self.camera.frame_size])
+        for marker in markers:
+            vector = marker.center - frame_center
+            coefficient = self.fcc_map[marker.id] if marker.id in self.fcc_map else 1
+            marker.center = np.array([int(x) for x in frame_center + vector * coefficient])
+
+    def get_key_position_roi(self, key_position, margin=20):
+        """
+        Returns the region of the frame that markers for the key position can be detected in. Marker
+        centers are pulled towards the frame center by the fid correction coefficients after detection,
+        so the key position ranges are expanded away from the frame center to contain the raw markers.
+        :param key_position: {KeyPosition} The key position.
+        :param margin: Additional pixels added to each side of the region.
+        :return: (x_range, y_range)
+        """
+        scale = 1 / min(list(self.fcc_map.values()) + [1])
+        frame_center = np.array([x / 2 for x in self.camera.frame_size])
+        (x0, x1), (y0, y1) = key_position.x_range, key_position.y_range
+        x0, x1 = [int(frame_center[0] + (x - frame_center[0]) * scale) for x in (x0, x1)]
+        y0, y1 = [int(frame_center[1] + (y - frame_center[1]) * scale) for y in (y0, y1)]
+        return (
+            (max(0, x0 - margin), min(self.camera.frame_size[0], x1 + margin)),
+            (max(0, y0 - margin), min(self.camera.frame_size[1], y1 + margin))
+        )
+
+    def get_square_roi(self, key_position, sid):
+        """
+        Returns the region of the frame that the marker of a piece on the square can be detected in. The
+        region spans from the square center to where a marker on top of a piece appears before the fid
+        correction, padded by half a square.
+        :return: (x_range, y_range)
+        """
+        scale = 1 / min(list(self.fcc_map.values()) + [1])
+        frame_center = np.array([x / 2 for x in self.camera.frame_size])
+        center = np.array(key_position.sid_centers[sid], dtype=np.float64)
+        raw = frame_center + (center - frame_center) * scale
+        half = key_position.square_spacing / 2 if np.isfinite(key_position.square_spacing) else 60
+        x0, x1 = min(center[0], raw[0]) - half, max(center[0], raw[0]) + half
+        y0, y1 = min(center[1], raw[1]) - half, max(center[1], raw[1]) + half
+        return (
+            (max(0, int(x0)), min(self.camera.frame_size[0], int(x1))),
+            (max(0, int(y0)), min(self.camera.frame_size[1], int(y1)))
+        )
+
+    def capture(self, key_position):
+        """
+        Captures a frame at the key position. The gantry must already be at the key position.
+        :return: The frame.
+        """
+        log.info('Taking snapshot from camera.')
+        rois = [self.get_key_position_roi(key_position)]
+        return self.camera.capture_frame(rois=rois if self.roi_undistortion else None)
+
+    def detect(self, key_position, frame, rois=None):
+        """
+        Extracts, adjusts and filters the piece markers visible from the key position.
+        :param rois: {[(x_range, y_range)]} Regions to search. Defaults to the key position region.
+        :return: {[Marker]} List of markers
+        """
+        if rois is None:
+            rois = [self.get_key_position_roi(key_position)]
+        markers = Marker.extract_markers(frame, marker_family=Marker.FAMILY_tag16h5, scan_for_inverted_markers=True,
+                                         rois=rois, roi_scale=self.roi_scale)
+        self.adjust_markers(markers)
+        markers = filter_markers_by_range(markers, x_range=key_position.x_range, y_range=key_position.y_range)
+        return filter_markers_by_id(markers, valid_ids=self.board.piece_fids)
+
+    def assign(self, key_position, markers, board_state, sids=None):
+        """
+        Merges the pieces of the markers into the board state.
+        :param sids: If provided, only markers closest to one of these sids are merged.
+        :throws: BoardPieceViolation if two different pieces are found on the same square.
+        """
+        closest_sids, distances = key_position.get_closest_sids([marker.center for marker in markers])
+        for marker, sid, distance in zip(markers, closest_sids, distances):
+            if sids is not None and sid not in sids:
+                continue
+            # Reject markers that do not sit on any square
+            if distance > key_position.square_spacing:
+                log.warn(f"Marker {marker} is {int(distance)}px from the closest square {sid}. Ignoring it.")
+                continue
+            piece_id = self.board.translate_fid_to_piece(marker.id)
+            if sid in board_state and board_state[sid] != piece_id:
+                raise BoardPieceViolation(f"Two pieces ({board_state[sid]}, {piece_id}) found in the same square: {sid}")
+            board_state[sid] = piece_id
+
+    def _detect_timed(self, key_position, frame, save_images):
+        start = time.time()
+        markers = self.detect(key_position, frame)
+        if save_images:
+            artifact_writer.submit(frame, self.camera, markers=markers, board=self.board)
+        return markers, time.time() - start
+
+    def scan(self, save_images=False, frame_callback=None):
+        """
+        Analyzes the board to find where all the pieces are. Capture of the next key position
+        proceeds while the previous frames are analyzed and results are merged as they complete.
+        :param frame_callback: Called with (key position index, frame) after each capture, before the frame is analyzed.
+        :return: ({dict} board state, {dict} seconds spent in each stage) The time spent travelling is
+        the time the scan waited on the gantry and detection time is summed over the workers.
+        """
+        log.info('Analyzing board.')
+        scan_start = time.time()
+        timings = {stage: 0.0 for stage in [BoardScanner.STAGE_TRAVEL, BoardScanner.STAGE_CAPTURE,
+                                            BoardScanner.STAGE_DETECT, BoardScanner.STAGE_ASSIGN]}
+        self.camera.start_session()
+        board_state = BoardState()
+        pending = []
+
+        def merge(block):
+            while len(pending) > 0 and (block or pending[0][1].done()):
+                key_position, detection = pending.pop(0)
+                markers, seconds = detection.result()
+                timings[BoardScanner.STAGE_DETECT] += seconds
+                start = time.time()
+                self.assign(key_position, markers, board_state)
+                timings[BoardScanner.STAGE_ASSIGN] += time.time() - start
+
+        x, y = self.key_positions[0].gantry_position
+        movement = self.gantry.executor.set_position(x, y)
+        for i, key_position in enumerate(self.key_positions):
+            start = time.time()
+            movement.result()
+            timings[BoardScanner.STAGE_TRAVEL] += time.time() - start
+            start = time.time()
+            frame = self.capture(key_position)
+            timings[BoardScanner.STAGE_CAPTURE] += time.time() - start
+            if frame_callback is not None:
+                frame_callback(i, frame)
+            if i + 1 < len(self.key_positions):
+                x, y = self.key_positions[i + 1].gantry_position
+                movement = self.gantry.executor.set_position(x, y)
+            pending.append((key_position, self.pool.submit(self._detect_timed, key_position, frame, save_images)))
+            merge(block=False)
+        merge(block=True)
+        timings[BoardScanner.STAGE_TOTAL] = time.time() - scan_start
+        log.info(f"Board state: {board_state}")
+        log.info('Board scan timings: ' + ', '.join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items()))
+        return board_state, timings
@@ -0,0 +1,137 @@
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+
+# Square order matches Board.get_all_sids, index = 8 * file + rank
+SIDS = tuple(f"{c}{r}" for c in 'abcdefgh' for r in range(1, 9))
+SID_INDEX = {sid: i for i, sid in enumerate(SIDS)}
+# Indices in FEN order, from a8 to h8 down to a1 to h1
+FEN_ORDER = tuple(8 * c + r for r in range(7, -1, -1) for c in range(8))
+
+EMPTY = 0
+
+
+class BoardState(MutableMapping):
+    """
+    Pieces on the board stored as one byte per square, the ascii code of the piece or 0 if the square
+    is empty. Behaves like the {sid: piece} dict used for board states throughout, so it can be passed
+    anywhere a dict was.
+    """
+
+    __slots__ = ('squares',)
+
+    def __init__(self, pieces=None):
+        """
+        :param pieces: {dict} Optional map of sids to pieces to start with.
+        """
+        self.squares = bytearray(64)
+        if isinstance(pieces, BoardState):
+            self.squares[:] = pieces.squares
+        elif pieces is not None:
+            for sid, piece in pieces.items():
+                self.squares[SID_INDEX[sid]] = ord(piece)
+
+    @staticmethod
+    def of(pieces):
+        """
+        :return: {BoardState} The pieces if they already are a board state, otherwise a board state holding them.
+        """
+        return pieces if isinstance(pieces, BoardState) else BoardState(pieces)
+
+    @staticmethod
+    def from_fen(fen):
+        """
+        :param fen: FEN string. Only the piece placement field is used.
+        """
+        state = BoardState()
+        i = 0
+        for char in fen.split(' ', 1)[0]:
+            if char == '/':
+                continue
+            if char.isdigit():
+                i += int(char)
+                continue
+            state.squares[FEN_ORDER[i]] = ord(char)
+            i += 1
+        return state
+
+    def to_fen(self):
+        """
+        :return: The piece placement field of the FEN.
+        """
+        rows = []
+        for r in range(8):
+            row, empty = '', 0
+            for i in FEN_ORDER[8 * r:8 * r + 8]:
+                value = self.squares[i]
+                if value == EMPTY:
+                    empty += 1
+                    continue
+                if empty > 0:
+                    row += str(empty)
+                    empty = 0
+                row += chr(value)
+            rows.append(row + (str(empty) if empty > 0 else ''))
+        return '/'.join(rows)
+
+    @property
+    def array(self):
+        """
+        :return: {np.array} Read only uint8 view of the squares.
+        """
+        array = np.frombuffer(self.squares, dtype=np.uint8)
+        array.flags.writeable = False
+        return array
+
+    def diff(self, other):
+        """
+        :param other: {dict} Board state to compare against.
+        :return: {[str]} Sids whose contents differ between the two states.
+        """
+        return [SIDS[i] for i in np.flatnonzero(self.array != BoardState.of(other).array)]
+
+    def count_pieces(self):
+        """
+        :return: {np.array} Number of each piece on the board indexed by the ascii code of the piece.
+        """
+        return np.bincount(self.array, minlength=128)
+
+    def copy(self):
+        return BoardState(self)
+
+    def __getitem__(self, sid):
+        value = self.squares[SID_INDEX[sid]] if sid in SID_INDEX else EMPTY
+        if value == EMPTY:
+            raise KeyError(sid)
+        return chr(value)
+
+    def __setitem__(self, sid, piece):
+        self.squares[SID_INDEX[sid]] = ord(piece)
+
+    def __delitem__(self, sid):
+        if self.squares[SID_INDEX[sid]] == EMPTY:
+            raise KeyError(sid)
+        self.squares[SID_INDEX[sid]] = EMPTY
+
+    def __contains__(self, sid):
+        return sid in SID_INDEX and self.squares[SID_INDEX[sid]] != EMPTY
+
+    def __iter__(self):
+        return (SIDS[i] for i, value in enumerate(self.squares) if value != EMPTY)
+
+    def __len__(self):
+        return 64 - self.squares.count(EMPTY)
+
+    def __eq__(self, other):
+        if isinstance(other, BoardState):
+            return self.squares == other.squares
+        if isinstance(other, Mapping):
+            return dict(self) == dict(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(bytes(self.squares))
+
+    def __repr__(self):
+        return repr(dict(self))
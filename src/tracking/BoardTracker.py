@@ -0,0 +1,128 @@
+import cv2
+import numpy as np
+
+from src.misc.Exceptions import InvalidMove, NoMoveFound
+from src.misc.Helpers import artifact_writer
+from src.misc.Log import log
+from src.tracking.Board import Board
+from src.tracking.BoardState import BoardState
+
+
+class IncrementalBoardTracker:
+    """
+    Tracks the board state between turns by rescanning only the squares that changed. A reference
+    frame is kept per key position and each new frame is compared to it square by square. Marker
+    detection only runs on squares whose image changed or that were touched by a move since the
+    reference was taken. Once the changes seen so far form a legal move, the remaining key positions
+    are not visited.
+    """
+
+    def __init__(self, scanner, difference_threshold=12):
+        """
+        :param scanner: {BoardScanner} Scanner providing capture and detection.
+        :param difference_threshold: Mean absolute gray level difference above which a square has changed.
+        """
+        self.scanner = scanner
+        self.difference_threshold = difference_threshold
+        self.board_state = None
+        self.reference_frames = {}
+        self.dirty_sids = set()
+
+    def reset(self, board_state=None):
+        """
+        Discards the reference frames. If a board state is given, the next scan runs one detection over
+        each key position's whole region and can still stop early once a legal move is found, otherwise
+        the next scan is a full scan of the board.
+        :param board_state: {dict} The state the board is expected to be in.
+        """
+        self.board_state = None if board_state is None else BoardState(board_state)
+        self.reference_frames = {}
+        self.dirty_sids = set()
+
+    def mark_changed(self, board_state):
+        """
+        Updates the tracked state after the board was changed by the machine. Squares that differ from
+        the tracked state are analyzed on the next scan regardless of the image difference.
+        :param board_state: {dict} The new state of the board.
+        """
+        if self.board_state is not None:
+            self.dirty_sids |= set(self.board_state.diff(board_state))
+        self.board_state = BoardState(board_state)
+
+    def get_changed_sids(self, key_position, reference, gray):
+        """
+        :return: {set} Sids of the key position whose region differs from the reference frame.
+        """
+        changed = set()
+        for sid in key_position.sids:
+            (x0, x1), (y0, y1) = self.scanner.get_square_roi(key_position, sid)
+            difference = cv2.absdiff(reference[y0:y1, x0:x1], gray[y0:y1, x0:x1])
+            if difference.size > 0 and np.mean(difference) > self.difference_threshold:
+                changed.add(sid)
+        return changed
+
+    def scan(self, previous_moves=None, chess_engine=None, save_images=False):
+        """
+        Analyzes the board, only running marker detection where something changed.
+        :param previous_moves: Moves made so far. Required to stop early once a legal move is found.
+        :param chess_engine: {Stockfish} Engine used to verify a move. Required to stop early.
+        :return: [square_id: piece.id] A map of square ids to piece ids.
+        """
+        if self.board_state is None:
+            log.info('No tracked board state, scanning the full board.')
+            references = {}
+            board_state, _ = self.scanner.scan(
+                save_images=save_images,
+                frame_callback=lambda i, frame: references.update({i: cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)})
+            )
+            self.board_state = BoardState(board_state)
+            self.reference_frames = references
+            self.dirty_sids = set()
+            return board_state
+        log.info('Analyzing changed squares on board.')
+        self.scanner.camera.start_session()
+        key_positions = self.scanner.key_positions
+        gantry = self.scanner.gantry
+        board_state = BoardState(self.board_state)
+        references = {}
+        visited_sids = set()
+        changed_sids = set()
+        for i, key_position in enumerate(key_positions):
+            # The next key position is only travelled to once it is known that it cannot be skipped
+            x, y = key_position.gantry_position
+            gantry.executor.set_position(x, y).result()
+            frame = self.scanner.capture(key_position)
+            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+            references[i] = gray
+            visited_sids |= set(key_position.sids)
+            if i in self.reference_frames:
+                changed = self.get_changed_sids(key_position, self.reference_frames[i], gray)
+                changed |= self.dirty_sids & set(key_position.sids)
+                rois = [self.scanner.get_square_roi(key_position, sid) for sid in changed]
+            else:
+                # Without a reference every square is analyzed, which one detection over the region does
+                changed = set(key_position.sids)
+                rois = None
+            log.info(f"Changed squares at key position {key_position.gantry_position}: {sorted(changed)}")
+            if len(changed) > 0:
+                markers = self.scanner.detect(key_position, frame, rois=rois)
+                for sid in changed:
+                    board_state.pop(sid, None)
+                self.scanner.assign(key_position, markers, board_state, sids=changed)
+                changed_sids |= changed
+                if save_images:
+                    artifact_writer.submit(frame, self.scanner.camera, markers=markers, board=self.scanner.board)
+            # Stop once the changes seen so far make up a legal move
+            if i + 1 < len(key_positions) and len(changed_sids) > 0 and chess_engine is not None:
+                try:
+                    move = Board.get_move_from_board_states(self.board_state, board_state, previous_moves,
+                                                            chess_engine)
+                    log.info(f"Changes form the legal move {move}, skipping remaining key positions.")
+                    break
+                except (InvalidMove, NoMoveFound):
+                    pass
+        self.board_state = BoardState(board_state)
+        self.reference_frames.update(references)
+        self.dirty_sids -= visited_sids
+        log.info(f"Board state: {board_state}")
+        return board_state
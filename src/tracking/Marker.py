@@ -1,3 +1,6 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import apriltag
 import cv2
@@ -7,6 +10,13 @@ from src.misc.Helpers import save_frame_to_runtime_dir
 from src.misc.Log import log
 
 
+# Apriltag detectors keep internal state and are not safe to share between threads. Detectors are
+# therefore cached per thread, keyed by family and options.
+_detector_cache = {}
+# The apriltag C detector releases the GIL so detection passes can run in parallel on this pool.
+_detection_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='apriltag')
+
+
 class Marker:
     """
     Represents a fiducial marker.
@@ -15,6 +25,9 @@ class Marker:
     FAMILY_tag16h5 = 'tag16h5'
     FAMILY_tag36h11 = 'tag36h11'
 
+    # Options passed to every apriltag detector, see {Marker.set_detector_options}
+    detector_options = {}
+
     def __init__(self, fid, corners):
         self.id = str(fid)
         self.corners = np.array(corners)
@@ -27,8 +40,7 @@ class Marker:
         return f"Marker(id: {self.id}, center: {self.center})"
 
     def adjust(self, x, y):
-        self.center[0] += x
-        self.center[1] += y
+        self.center = (self.center[0] + x, self.center[1] + y)
         for i in range(len(self.corners)):
             self.corners[i][0] += x
             self.corners[i][1] += y
@@ -38,48 +50,109 @@ class Marker:
         return [marker.id for marker in markers]
 
     @staticmethod
-    def extract_markers(frame, marker_family, scan_for_inverted_markers=False):
+    def set_detector_options(**options):
+        """
+        Sets the tuning options used by apriltag detectors. Accepts any {apriltag.DetectorOptions}
+        keyword, e.g. quad_decimate, nthreads and refine_edges.
+        """
+        log.info(f"Setting apriltag detector options {options}")
+        Marker.detector_options = dict(options)
+
+    @staticmethod
+    def get_detector(marker_family):
+        """
+        Returns a cached detector for the marker family, the current detector options and the calling thread.
+        :param marker_family: The marker family to detect.
+        :return: {apriltag.Detector}
+        """
+        key = (marker_family, tuple(sorted(Marker.detector_options.items())), threading.get_ident())
+        if key not in _detector_cache:
+            options = apriltag.DetectorOptions(families=marker_family, **Marker.detector_options)
+            _detector_cache[key] = apriltag.Detector(options)
+        return _detector_cache[key]
+
+    @staticmethod
+    def detect(gray, marker_family):
+        """
+        Runs apriltag detection on a grayscale frame.
+        :return: Raw detection results.
+        """
+        return Marker.get_detector(marker_family).detect(gray)
+
+    @staticmethod
+    def from_detection(detection, scale=1):
+        """
+        Creates a marker from an apriltag detection result.
+        :param scale: The scale of the detected image relative to the frame.
+        """
+        corners = [np.array([int(x / scale), int(y / scale)]) for x, y in detection.corners]
+        return Marker(str(detection.tag_id), corners)
+
+    @staticmethod
+    def detect_in_region(frame, marker_family, roi, roi_scale=1, inverted=False):
+        """
+        Detects markers within a region of the frame. Marker coordinates are mapped back to the full frame.
+        :param roi: (x_range, y_range) region of the frame to search.
+        :param roi_scale: Factor the region is resized by before detection.
+        :param inverted: Searches the region with inverted colors for inverted markers.
+        :return: {[Marker]} List of markers
+        """
+        (x0, x1), (y0, y1) = roi
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        crop = frame[y0:int(y1), x0:int(x1)]
+        if crop.size == 0:
+            return []
+        gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+        if roi_scale != 1:
+            gray = cv2.resize(gray, None, fx=roi_scale, fy=roi_scale, interpolation=cv2.INTER_AREA)
+        gray = Camera.blur_frame(gray, 2)
+        if inverted:
+            gray = Camera.invert_colors(gray)
+        markers = [Marker.from_detection(r, scale=roi_scale) for r in Marker.detect(gray, marker_family)]
+        for marker in markers:
+            marker.adjust(x0, y0)
+        return markers
+
+    @staticmethod
+    def extract_markers(frame, marker_family, scan_for_inverted_markers=False, rois=None, roi_scale=1):
         """
         Takes in a RGB color frame and extracts all of the apriltag markers present. Returns a list of markers.
         :param frame: The frame to search.
         :param marker_family: The marker family to search for.
         :param scan_for_inverted_markers: Determines if the image should be checked for markers that are inverted.
+        :param rois: {[(x_range, y_range)]} If provided, only these regions of the frame are searched.
+        :param roi_scale: Factor each region is resized by before detection, e.g. 0.5 to halve the resolution.
         :return: {[Marker]} List of markers
         """
         log.info('Extracting apriltag markers from camera frame.'
-                 + (' Checking for inverted markers as well.' if scan_for_inverted_markers else ''))
-        markers = []
-        options = apriltag.DetectorOptions(families=marker_family)
-        detector = apriltag.Detector(options)
+                 + (' Checking for inverted markers as well.' if scan_for_inverted_markers else '')
+                 + (f" Searching {len(rois)} regions." if rois is not None else ''))
+        if rois is not None:
+            # The normal and inverted searches of every region run as separate tasks so they run in parallel
+            futures = [
+                _detection_pool.submit(Marker.detect_in_region, frame, marker_family, roi, roi_scale, inverted)
+                for roi in rois
+                for inverted in ([False, True] if scan_for_inverted_markers else [False])
+            ]
+            markers = []
+            found = set()
+            for future in futures:
+                for marker in future.result():
+                    # Overlapping regions can detect the same marker twice
+                    if (marker.id, marker.center) in found:
+                        continue
+                    found.add((marker.id, marker.center))
+                    markers.append(marker)
+            log.info('Found %d markers: %s', len(markers), Marker.get_fids_from_list(markers))
+            return markers
         gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
         gray = Camera.blur_frame(gray, 2)
-        results = detector.detect(gray)
+        inverted_results = None
         if scan_for_inverted_markers:
-            results += detector.detect(Camera.invert_colors(gray))
-        for r in results:
-            c0, c1, c2, c3 = r.corners
-            c0 = np.array([
-                int(c0[0]),
-                int(c0[1])
-            ])
-            c1 = np.array([
-                int(c1[0]),
-                int(c1[1])
-            ])
-            c2 = np.array([
-                int(c2[0]),
-                int(c2[1])
-            ])
-            c3 = np.array([
-                int(c3[0]),
-                int(c3[1])
-            ])
-            fid = str(r.tag_id)
-            markers.append(
-                Marker(
-                    fid,
-                    [c0, c1, c2, c3]
-                )
-            )
-        log.info(f"Found {len(markers)} markers: {Marker.get_fids_from_list(markers)}")
+            inverted_results = _detection_pool.submit(Marker.detect, Camera.invert_colors(gray), marker_family)
+        results = Marker.detect(gray, marker_family)
+        if inverted_results is not None:
+            results += inverted_results.result()
+        markers = [Marker.from_detection(r) for r in results]
+        log.info('Found %d markers: %s', len(markers), Marker.get_fids_from_list(markers))
         return markers
@@ -0,0 +1,195 @@
+from src.tracking.Board import Board
+from src.tracking.BoardState import BoardState
+
+
+FILES = 'abcdefgh'
+
+KNIGHT_OFFSETS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+KING_OFFSETS = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+ROOK_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+BISHOP_DIRECTIONS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+PROMOTION_PIECES = 'qrbn'
+
+# Squares the king and rook travel between for each castling right
+CASTLING_MOVES = {
+    'K': ('e1g1', 'h1', 'f1', ('f1', 'g1'), ('e1', 'f1', 'g1')),
+    'Q': ('e1c1', 'a1', 'd1', ('b1', 'c1', 'd1'), ('e1', 'd1', 'c1')),
+    'k': ('e8g8', 'h8', 'f8', ('f8', 'g8'), ('e8', 'f8', 'g8')),
+    'q': ('e8c8', 'a8', 'd8', ('b8', 'c8', 'd8'), ('e8', 'd8', 'c8')),
+}
+
+
+def to_sid(col, row):
+    return f"{FILES[col]}{row + 1}"
+
+
+def to_coordinates(sid):
+    return FILES.index(sid[0]), int(sid[1]) - 1
+
+
+def is_white(piece):
+    return piece.isupper()
+
+
+def parse_fen(fen):
+    """
+    :param fen: Full FEN string.
+    :return: (board_state, white_to_move, castling_rights, en_passant_sid)
+    """
+    fields = fen.split()
+    board_state = Board.fen_to_board_state(fields[0])
+    white_to_move = len(fields) < 2 or fields[1] == 'w'
+    castling = fields[2] if len(fields) > 2 and fields[2] != '-' else ''
+    en_passant = fields[3] if len(fields) > 3 and fields[3] != '-' else None
+    return board_state, white_to_move, castling, en_passant
+
+
+def is_attacked(board_state, sid, by_white):
+    """
+    :return: {bool} True if a piece of the given color attacks the square.
+    """
+    col, row = to_coordinates(sid)
+
+    def piece_at(c, r):
+        if 0 <= c < 8 and 0 <= r < 8:
+            return board_state.get(to_sid(c, r))
+        return None
+
+    def is_enemy(piece, kinds):
+        return piece is not None and is_white(piece) == by_white and piece.lower() in kinds
+
+    # Pawns attack diagonally forwards, so look backwards from the square
+    pawn_row = row - 1 if by_white else row + 1
+    if any(is_enemy(piece_at(col + dc, pawn_row), 'p') for dc in (-1, 1)):
+        return True
+    if any(is_enemy(piece_at(col + dc, row + dr), 'n') for dc, dr in KNIGHT_OFFSETS):
+        return True
+    if any(is_enemy(piece_at(col + dc, row + dr), 'k') for dc, dr in KING_OFFSETS):
+        return True
+    for directions, kinds in ((ROOK_DIRECTIONS, 'rq'), (BISHOP_DIRECTIONS, 'bq')):
+        for dc, dr in directions:
+            c, r = col + dc, row + dr
+            while 0 <= c < 8 and 0 <= r < 8:
+                piece = piece_at(c, r)
+                if piece is not None:
+                    if is_enemy(piece, kinds):
+                        return True
+                    break
+                c, r = c + dc, r + dr
+    return False
+
+
+def generate_pseudo_legal_moves(board_state, white_to_move, castling='', en_passant=None):
+    """
+    Generates the moves of the side to move without checking whether the king is left in check.
+    :return: {[str]} Moves in UCI notation.
+    """
+    moves = []
+    for sid, piece in board_state.items():
+        if is_white(piece) != white_to_move:
+            continue
+        col, row = to_coordinates(sid)
+        kind = piece.lower()
+        if kind == 'p':
+            forward = 1 if white_to_move else -1
+            start_row, last_row = (1, 7) if white_to_move else (6, 0)
+            targets = []
+            one = (col, row + forward)
+            if 0 <= one[1] < 8 and to_sid(*one) not in board_state:
+                targets.append(one)
+                two = (col, row + 2 * forward)
+                if row == start_row and to_sid(*two) not in board_state:
+                    targets.append(two)
+            for dc in (-1, 1):
+                c, r = col + dc, row + forward
+                if not (0 <= c < 8 and 0 <= r < 8):
+                    continue
+                target = board_state.get(to_sid(c, r))
+                if (target is not None and is_white(target) != white_to_move) or to_sid(c, r) == en_passant:
+                    targets.append((c, r))
+            for c, r in targets:
+                if r == last_row:
+                    moves += [f"{sid}{to_sid(c, r)}{p}" for p in PROMOTION_PIECES]
+                else:
+                    moves.append(f"{sid}{to_sid(c, r)}")
+            continue
+        if kind in 'nk':
+            for dc, dr in (KNIGHT_OFFSETS if kind == 'n' else KING_OFFSETS):
+                c, r = col + dc, row + dr
+                if not (0 <= c < 8 and 0 <= r < 8):
+                    continue
+                target = board_state.get(to_sid(c, r))
+                if target is None or is_white(target) != white_to_move:
+                    moves.append(f"{sid}{to_sid(c, r)}")
+            continue
+        directions = {'r': ROOK_DIRECTIONS, 'b': BISHOP_DIRECTIONS, 'q': ROOK_DIRECTIONS + BISHOP_DIRECTIONS}[kind]
+        for dc, dr in directions:
+            c, r = col + dc, row + dr
+            while 0 <= c < 8 and 0 <= r < 8:
+                target = board_state.get(to_sid(c, r))
+                if target is None or is_white(target) != white_to_move:
+                    moves.append(f"{sid}{to_sid(c, r)}")
+                if target is not None:
+                    break
+                c, r = c + dc, r + dr
+    # Castling requires the squares between king and rook to be empty and the king to not pass through check
+    for right in castling:
+        if is_white(right) != white_to_move or right not in CASTLING_MOVES:
+            continue
+        move, rook_sid, _, empty_sids, safe_sids = CASTLING_MOVES[right]
+        king = 'K' if white_to_move else 'k'
+        rook = 'R' if white_to_move else 'r'
+        if board_state.get(move[:2]) != king or board_state.get(rook_sid) != rook:
+            continue
+        if any(sid in board_state for sid in empty_sids):
+            continue
+        if any(is_attacked(board_state, sid, not white_to_move) for sid in safe_sids):
+            continue
+        moves.append(move)
+    return moves
+
+
+def apply_move(board_state, move, en_passant=None):
+    """
+    :return: {BoardState} A new board state with the move made, including castling, en passant and promotion.
+    """
+    s_sid, e_sid = move[:2], move[2:4]
+    after = BoardState(board_state)
+    piece = after.pop(s_sid)
+    if len(move) == 5:
+        piece = move[4].upper() if is_white(piece) else move[4].lower()
+    # En passant captures the pawn behind the target square
+    if piece.lower() == 'p' and e_sid == en_passant and e_sid not in board_state:
+        after.pop(f"{e_sid[0]}{s_sid[1]}", None)
+    # Castling moves the rook over the king
+    if piece.lower() == 'k':
+        for right, (castling_move, rook_sid, rook_target, _, _) in CASTLING_MOVES.items():
+            if move == castling_move and after.get(rook_sid) is not None:
+                after[rook_target] = after.pop(rook_sid)
+    after[e_sid] = piece
+    return after
+
+
+def generate_legal_moves(fen):
+    """
+    :param fen: Full FEN string of the current position.
+    :return: {dict} Map of every legal move in UCI notation to the board state after the move.
+    """
+    board_state, white_to_move, castling, en_passant = parse_fen(fen)
+    king = 'K' if white_to_move else 'k'
+    legal_moves = {}
+    for move in generate_pseudo_legal_moves(board_state, white_to_move, castling, en_passant):
+        after = apply_move(board_state, move, en_passant)
+        king_sids = [sid for sid, piece in after.items() if piece == king]
+        if len(king_sids) > 0 and is_attacked(after, king_sids[0], not white_to_move):
+            continue
+        legal_moves[move] = after
+    return legal_moves
+
+
+def get_changed_sids(board_state_before, board_state_after):
+    """
+    :return: {set} Sids whose contents differ between the two board states.
+    """
+    return set(BoardState.of(board_state_before).diff(board_state_after))
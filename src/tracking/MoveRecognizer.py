@@ -0,0 +1,128 @@
+from src.misc.Exceptions import InvalidMove, NoMoveFound
+from src.misc.Helpers import artifact_writer
+from src.misc.Log import log
+from src.tracking.MoveGenerator import generate_legal_moves, parse_fen, get_changed_sids
+
+
+class MoveRecognizer:
+    """
+    Recognizes the move made by the player by checking the board against every legal move instead of
+    scanning the full board. The squares each candidate is expected to change are known up front, so
+    only squares whose expected contents differ between the remaining candidates are observed. Key
+    positions are visited in the order that eliminates the most candidates until one remains.
+    """
+
+    def __init__(self, scanner):
+        """
+        :param scanner: {BoardScanner} Scanner providing capture and detection.
+        """
+        self.scanner = scanner
+
+    @staticmethod
+    def get_candidates(fen):
+        """
+        :param fen: Full FEN string of the position before the player's move.
+        :return: {dict} Map of each candidate move to the expected board state. The None candidate is
+        the board without any move made.
+        """
+        board_state, _, _, _ = parse_fen(fen)
+        candidates = generate_legal_moves(fen)
+        candidates[None] = board_state
+        return candidates
+
+    @staticmethod
+    def get_discriminating_sids(candidates):
+        """
+        :return: {set} Sids whose expected contents are not the same for all candidates.
+        """
+        states = list(candidates.values())
+        sids = set()
+        for state in states[1:]:
+            sids |= get_changed_sids(states[0], state)
+        return sids
+
+    def choose_observation(self, candidates, frames):
+        """
+        Picks the key position whose discriminating squares split the candidates into the smallest groups.
+        Key positions that were already captured are preferred as they do not require travelling.
+        :return: (key position index, {set} sids to observe) or None if no square discriminates.
+        """
+        discriminating = MoveRecognizer.get_discriminating_sids(candidates)
+        best, best_score = None, None
+        for i, key_position in enumerate(self.scanner.key_positions):
+            sids = sorted(discriminating & set(key_position.sids))
+            if len(sids) == 0:
+                continue
+            groups = {}
+            for state in candidates.values():
+                signature = tuple(state.get(sid) for sid in sids)
+                groups[signature] = groups.get(signature, 0) + 1
+            score = (max(groups.values()), i not in frames, len(sids))
+            if best_score is None or score < best_score:
+                best, best_score = (i, set(sids)), score
+        return best
+
+    def observe(self, index, sids, frames, save_images=False):
+        """
+        Captures the key position if needed and detects the contents of the squares.
+        :return: {dict} Map of each sid to the piece observed on it, None if it is empty.
+        """
+        key_position = self.scanner.key_positions[index]
+        if index not in frames:
+            x, y = key_position.gantry_position
+            self.scanner.gantry.executor.set_position(x, y).result()
+            frames[index] = self.scanner.capture(key_position)
+        frame = frames[index]
+        rois = [self.scanner.get_square_roi(key_position, sid) for sid in sids]
+        markers = self.scanner.detect(key_position, frame, rois=rois)
+        if save_images:
+            # The frame may be observed again, so the writer annotates a copy
+            artifact_writer.submit(frame.copy(), self.scanner.camera, markers=markers, board=self.scanner.board)
+        board_state = {}
+        self.scanner.assign(key_position, markers, board_state, sids=sids)
+        observed = {sid: board_state.get(sid) for sid in sids}
+        log.info(f"Observed squares at key position {key_position.gantry_position}: {observed}")
+        return observed
+
+    def recognize(self, fen, save_images=False):
+        """
+        Determines the move made by the player.
+        :param fen: Full FEN string of the position before the player's move.
+        :return: (move, board state after the move)
+        :throws: InvalidMove if the observed squares match no legal move, NoMoveFound if the board is unchanged.
+        """
+        log.info('Recognizing move from candidate moves.')
+        self.scanner.camera.start_session()
+        candidates = MoveRecognizer.get_candidates(fen)
+        log.info(f"{len(candidates) - 1} legal moves.")
+        frames = {}
+        observed = {}
+        while len(candidates) > 1:
+            observation = self.choose_observation(candidates, frames)
+            if observation is None:
+                break
+            index, sids = observation
+            observed.update(self.observe(index, sids, frames, save_images))
+            candidates = {move: state for move, state in candidates.items()
+                          if all(state.get(sid) == piece for sid, piece in observed.items())}
+            log.info(f"{len(candidates)} candidates remaining.")
+        if len(candidates) == 0:
+            raise InvalidMove(f"Observed squares {observed} do not match any legal move.")
+        if len(candidates) > 1:
+            raise InvalidMove(f"Could not distinguish between moves {[m for m in candidates if m is not None]}.")
+        move, board_state = next(iter(candidates.items()))
+        if move is None:
+            raise NoMoveFound()
+        # Confirm squares changed by the move that are visible in the frames already captured
+        before, _, _, _ = parse_fen(fen)
+        unconfirmed = get_changed_sids(before, board_state) - set(observed)
+        for index in list(frames):
+            sids = unconfirmed & set(self.scanner.key_positions[index].sids)
+            if len(sids) == 0:
+                continue
+            for sid, piece in self.observe(index, sids, frames).items():
+                if board_state.get(sid) != piece:
+                    raise InvalidMove(f"Square {sid} does not match move {move}.")
+            unconfirmed -= sids
+        log.info(f"Recognized move {move}")
+        return move, board_state